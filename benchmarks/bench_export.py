@@ -0,0 +1,95 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_path)
+
+from pixivo.export import ResultExporter, clear_path, export_modes
+
+
+def make_files(path, number, size):
+    os.makedirs(path)
+    data = os.urandom(size)
+    files = []
+    for i in range(number):
+        file_path = os.path.join(path, '{}_p0.jpg'.format(i))
+        with open(file_path, 'wb') as fp:
+            fp.write(data)
+        files.append(file_path)
+    return files
+
+
+def export_sequential(files, result_path):
+    # what the searcher did before: one shutil.copy after another
+    for file_path in files:
+        shutil.copy(file_path, os.path.join(
+            result_path, os.path.basename(file_path)))
+
+
+def export_parallel(files, result_path, mode, workers, archive=None):
+    exporter = ResultExporter(result_path, mode, workers, archive)
+    for file_path in files:
+        exporter.add(file_path, os.path.basename(file_path))
+    exporter.close()
+    return exporter.summary()
+
+
+def clear_sequential(result_path):
+    for name in os.listdir(result_path):
+        os.remove(os.path.join(result_path, name))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export generated files into a result path.')
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--kib', type=int, default=512)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--result', help='a directory for the result path, '
+                        'e.g. on another device; only a new subdirectory '
+                        'of it is written and cleared')
+    args = parser.parse_args()
+
+    work_path = tempfile.mkdtemp(prefix='pixivo-bench-')
+    if args.result:
+        result_path = tempfile.mkdtemp(prefix='pixivo-bench-', dir=args.result)
+    else:
+        result_path = os.path.join(work_path, 'result')
+        os.makedirs(result_path)
+    try:
+        files = make_files(os.path.join(work_path, 'files'),
+                           args.files, args.kib * 1024)
+        print('{:<18}{:>10}{:>10}  {}'.format('case', 'export s', 'clear s', 'result'))
+        cases = [('sequential copy', None, None)] + \
+            [(mode, mode, None) for mode in export_modes] + \
+            [('zip archive', 'copy', 'results.zip'),
+             ('tar archive', 'copy', 'results.tar')]
+        for name, mode, archive in cases:
+            st = time.perf_counter()
+            if mode is None:
+                export_sequential(files, result_path)
+                summary = '{} copied'.format(len(files))
+            else:
+                summary = export_parallel(
+                    files, result_path, mode, args.workers, archive)
+            export_time = time.perf_counter() - st
+            st = time.perf_counter()
+            if mode is None:
+                clear_sequential(result_path)
+            else:
+                clear_path(result_path, args.workers)
+            clear_time = time.perf_counter() - st
+            print('{:<18}{:>10.2f}{:>10.2f}  {}'.format(
+                name, export_time, clear_time, summary))
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+        if args.result:
+            shutil.rmtree(result_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bs4 import BeautifulSoup
+
+from pixivo.extractor import manga_image_url, original_image_url
+
+fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def soup_original_image_url(page):
+    return BeautifulSoup(page, 'lxml').select_one(
+        'img.original-image').attrs['data-src']
+
+
+def soup_manga_image_url(page):
+    return BeautifulSoup(page, 'lxml').select_one('body > img').attrs['src']
+
+
+cases = [
+    ('medium.html', original_image_url, soup_original_image_url),
+    ('manga_big.html', manga_image_url, soup_manga_image_url)
+]
+
+
+def bench(func, page, number):
+    return min(timeit.repeat(
+        lambda: func(page), number=number, repeat=3)) / number
+
+
+def main(number=20):
+    print('{:<16}{:>12}{:>14}{:>10}'.format(
+        'fixture', 'fast (ms)', 'soup (ms)', 'speedup'))
+    for name, fast, soup in cases:
+        with open(os.path.join(fixtures_path, name), encoding='utf-8') as fp:
+            page = fp.read()
+        if fast(page) != soup(page):
+            raise SystemExit('{}: results differ!'.format(name))
+        fast_time = bench(fast, page, number)
+        soup_time = bench(soup, page, number)
+        print('{:<16}{:>12.3f}{:>14.3f}{:>9.0f}x'.format(
+            name, fast_time * 1000, soup_time * 1000, soup_time / fast_time))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
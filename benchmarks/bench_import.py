@@ -0,0 +1,56 @@
+import os
+import subprocess
+import sys
+
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules which must stay out of the search and the bare package import
+heavy_modules = ('aiohttp', 'imageio', 'numpy', 'bs4', 'lxml', 'pytz', 'PIL')
+
+cases = [
+    ('python', 'pass'),
+    ('import pixivo', 'import pixivo'),
+    ('search path', 'import pixivo.__main__, pixivo.pixiv_search'),
+    ('spider path', 'import pixivo.pixiv_rank'),
+    ('downloader path', 'import pixivo.downloader')
+]
+
+light_cases = ('import pixivo', 'search path')
+
+probe = '''
+import sys, time
+st = time.perf_counter()
+{}
+elapsed = time.perf_counter() - st
+heavy = [name for name in {!r} if name in sys.modules]
+print(elapsed, ','.join(heavy))
+'''
+
+
+def measure(code, number):
+    best = None
+    heavy = ''
+    for _ in range(number):
+        output = subprocess.check_output(
+            [sys.executable, '-c', probe.format(code, heavy_modules)],
+            cwd=root_path)
+        elapsed, heavy = output.decode().strip().partition(' ')[::2]
+        elapsed = float(elapsed)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, heavy
+
+
+def main(number=5):
+    failed = False
+    print('{:<18}{:>12}  {}'.format('case', 'import (ms)', 'heavy modules'))
+    for name, code in cases:
+        elapsed, heavy = measure(code, number)
+        print('{:<18}{:>12.1f}  {}'.format(name, elapsed * 1000, heavy or '-'))
+        if name in light_cases and heavy:
+            failed = True
+    if failed:
+        raise SystemExit('Heavy modules are imported on a light path!')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
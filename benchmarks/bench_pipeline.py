@@ -0,0 +1,255 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+root_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_path)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import standin
+
+config_template = '''path: _pixivo
+proxy:
+conn_limit: 100
+conn_limit_per_host: {concurrency}
+host_rate: 100000
+retries: 5
+backoff_base: 0.05
+backoff_max: 2
+db_journal_mode: wal
+db_synchronous: normal
+r18: off
+type: all
+date: 20180214
+mode: daily
+rank_concurrency: 4
+r_path: _result
+concurrency: {concurrency}
+resolve_concurrency: {resolve_concurrency}
+report_interval: 3600
+ugoira_format: {ugoira_format}
+'''
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise SystemExit('The stand-in did not start on port {}!'.format(port))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class _TimedRequest:
+
+    def __init__(self, ctx, latencies):
+        self.ctx = ctx
+        self.latencies = latencies
+
+    async def __aenter__(self):
+        st = time.perf_counter()
+        resp = await self.ctx.__aenter__()
+        self.latencies.append(time.perf_counter() - st)
+        return resp
+
+    async def __aexit__(self, *exc_info):
+        return await self.ctx.__aexit__(*exc_info)
+
+
+def route_to_standin(base, latencies):
+    # the crawler only knows the real hosts, send them to the stand-in and
+    # time each request up to its response headers
+    from pixivo.httpclient import HttpClient
+
+    request = HttpClient.request
+
+    def standin_request(self, url, *args, **kwargs):
+        for host in ('https://www.pixiv.net', 'https://i.pximg.net'):
+            if url.startswith(host):
+                url = base + url[len(host):]
+        return _TimedRequest(request(self, url, *args, **kwargs), latencies)
+    HttpClient.request = standin_request
+
+
+async def crawl(base):
+    from pixivo.context import PixivoContext
+    from pixivo.downloader import PixivoDownloader
+    from pixivo.pixiv_rank import PixivoRankSpider
+
+    result = {}
+    latencies = []
+    route_to_standin(base, latencies)
+    context = PixivoContext()
+
+    st = time.perf_counter()
+    await PixivoRankSpider(context).getRankingList()
+    result['rank_time'] = time.perf_counter() - st
+    result['rank_p50'] = percentile(latencies, 50)
+    result['rank_p99'] = percentile(latencies, 99)
+    del latencies[:]
+
+    st = time.perf_counter()
+    downloader = PixivoDownloader(context)
+    result['prepare_time'] = time.perf_counter() - st
+    st = time.perf_counter()
+    await downloader.start()
+    result['download_time'] = time.perf_counter() - st
+    result['files'] = downloader.dl_files
+    result['bytes'] = downloader.dl_bytes
+    result['converted'] = downloader.converted
+    result['dl_p50'] = percentile(latencies, 50)
+    result['dl_p99'] = percentile(latencies, 99)
+    await context.close()
+    return result
+
+
+def run_case(case):
+    work_path = tempfile.mkdtemp(prefix='pixivo-bench-')
+    port = free_port()
+    server = multiprocessing.Process(target=standin.run, args=(port,), kwargs={
+        'illusts': case['size'],
+        'latency': case['latency'],
+        'jitter': case['jitter'],
+        'bandwidth': case['bandwidth'],
+        'error_rate': case['error_rate'],
+        'image_size': case['image_size']
+    }, daemon=True)
+    server.start()
+    try:
+        wait_port(port)
+        os.chdir(work_path)
+        os.mkdir('_pixivo')
+        with open('_config.yml', 'w') as fp:
+            fp.write(config_template.format(**case))
+        # the crawler reports every file, keep that out of the results
+        stdout = sys.stdout
+        with open(os.devnull, 'w') as devnull:
+            sys.stdout = devnull
+            try:
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+                result = loop.run_until_complete(
+                    crawl('http://127.0.0.1:{}'.format(port)))
+            finally:
+                sys.stdout = stdout
+        result['rss'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024
+        return result
+    finally:
+        server.terminate()
+        server.join()
+        os.chdir(root_path)
+        shutil.rmtree(work_path, ignore_errors=True)
+
+
+def bench_convert(frames, frame_size, formats, number):
+    from pixivo.ugoira import convert_ugoira, ugoira_names
+
+    site = standin.PixivStandIn(illusts=1, frames=frames, frame_size=frame_size)
+    zip_data = site.zip_data(1)
+    frames_info = [{'file': name, 'delay': 50} for name, _ in site.frames]
+    work_path = tempfile.mkdtemp(prefix='pixivo-bench-')
+    try:
+        print('\n{:<10}{:>8}{:>14}'.format('format', 'frames', 'convert (ms)'))
+        for ugoira_format in formats:
+            times = []
+            for _ in range(number):
+                zip_path = os.path.join(work_path, 'ugoira.zip')
+                with open(zip_path, 'wb') as fp:
+                    fp.write(zip_data)
+                times.append(convert_ugoira(
+                    zip_path, frames_info,
+                    os.path.join(work_path, ugoira_names[ugoira_format]),
+                    ugoira_format))
+            print('{:<10}{:>8}{:>14.1f}'.format(
+                ugoira_format, frames, min(times) * 1000))
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+
+def print_result(case, result):
+    print('{:>6}{:>6}{:>9.1f}{:>9.1f}{:>9.1f}{:>8}{:>10.1f}{:>9.1f}{:>9.1f}{:>9.1f}{:>9.1f}'.format(
+        case['size'], case['concurrency'],
+        result['rank_time'], result['prepare_time'],
+        result['download_time'], result['files'],
+        result['files'] / result['download_time'],
+        result['bytes'] / result['download_time'] / 1048576,
+        result['dl_p50'] * 1000, result['dl_p99'] * 1000, result['rss']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Crawl and download from a local pixiv stand-in.')
+    parser.add_argument('--sizes', default='100,500',
+                        help='illusts in the ranking, comma separated')
+    parser.add_argument('--concurrency', default='4,16',
+                        help='download workers, comma separated')
+    parser.add_argument('--resolve-concurrency', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='bytes per second of each response, 0 unlimited')
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--image-kib', type=int, default=256)
+    parser.add_argument('--ugoira-format', default='gif')
+    parser.add_argument('--frames', type=int, default=30)
+    parser.add_argument('--no-convert', action='store_true',
+                        help='skip the ugoira conversion benchmark')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    print('{:>6}{:>6}{:>9}{:>9}{:>9}{:>8}{:>10}{:>9}{:>9}{:>9}{:>9}'.format(
+        'size', 'conc', 'rank s', 'prep s', 'dl s', 'files',
+        'files/s', 'MiB/s', 'p50 ms', 'p99 ms', 'rss MiB'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for concurrency in [int(conc) for conc in args.concurrency.split(',')]:
+            case = {
+                'size': size,
+                'concurrency': concurrency,
+                'resolve_concurrency': args.resolve_concurrency,
+                'latency': args.latency,
+                'jitter': args.jitter,
+                'bandwidth': args.bandwidth,
+                'error_rate': args.error_rate,
+                'image_size': args.image_kib * 1024,
+                'ugoira_format': args.ugoira_format
+            }
+            # a fresh process per case, so the peak RSS is its own
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__),
+                 '--case', json.dumps(case)])
+            print_result(case, json.loads(output.decode().splitlines()[-1]))
+    if not args.no_convert:
+        bench_convert(args.frames, 64, ('gif', 'webp', 'apng'), 3)
+
+
+if __name__ == '__main__':
+    main()
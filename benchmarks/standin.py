@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import io
+import json
+import random
+import struct
+import zipfile
+import zlib
+
+from aiohttp import web
+
+date_path = '2018/02/14/00/00/05'
+context_token = '0123456789abcdef0123456789abcdef'
+chunk_size = 65536
+
+
+def _png(width, height, rng):
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + \
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    rows = b''.join(
+        b'\x00' + bytes(rng.getrandbits(8) for _ in range(width * 3))
+        for _ in range(height))
+    return b'\x89PNG\r\n\x1a\n' + \
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+class PixivStandIn:
+    # a local www.pixiv.net and i.pximg.net serving a generated ranking with
+    # its pages, images and ugoira zips, with injectable latency, bandwidth
+    # limits and errors
+
+    def __init__(self, illusts=100, manga_ratio=0.2, ugoira_ratio=0.1,
+                 manga_pages=3, image_size=262144, frames=10, frame_size=64,
+                 latency=0, jitter=0, bandwidth=0, error_rate=0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.manga_pages = manga_pages
+        self.rng = random.Random(seed)
+        self.base = ''
+
+        self.types = {}
+        for illust_id in range(1, illusts + 1):
+            roll = self.rng.random()
+            self.types[illust_id] = 2 if roll < ugoira_ratio else \
+                1 if roll < ugoira_ratio + manga_ratio else 0
+        self.image = bytes(self.rng.getrandbits(8) for _ in range(image_size))
+        self.frames = [('%06d.png' % i, _png(frame_size, frame_size, self.rng))
+                       for i in range(frames)]
+        self.stats = {'requests': 0, 'errors': 0, 'resets': 0, 'bytes': 0}
+
+    def __image(self, name):
+        # unique content per file, so nothing is deduplicated
+        return name.encode() + self.image
+
+    def zip_data(self, illust_id):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+            for name, data in self.frames:
+                zf.writestr(name, data)
+            zf.comment = str(illust_id).encode()
+        return buf.getvalue()
+
+    def __entry(self, illust_id, rank):
+        illust_type = self.types[illust_id]
+        return {
+            'rank': rank,
+            'illust_id': illust_id,
+            'illust_type': str(illust_type),
+            'title': 'illust {}'.format(illust_id),
+            'illust_upload_timestamp': 1518534005,
+            'illust_page_count': str(self.manga_pages if illust_type == 1 else 1),
+            'user_id': illust_id % 97 + 1,
+            'user_name': 'user {}'.format(illust_id % 97 + 1),
+            'tags': ['tag{}'.format(illust_id % 13), 'tag{}'.format(illust_id % 7)],
+            'rating_count': illust_id * 3,
+            'view_count': illust_id * 30,
+            'url': '{}/c/240x480/img-master/img/{}/{}_p0_master1200.jpg'.format(
+                self.base, date_path, illust_id)
+        }
+
+    async def __delay(self):
+        delay = self.latency + self.rng.random() * self.jitter
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def __send(self, request, body, status=200, headers=None):
+        # an injected error is either a throttling status or a reset midway
+        self.stats['requests'] += 1
+        await self.__delay()
+        reset = False
+        if self.error_rate and self.rng.random() < self.error_rate:
+            if self.rng.random() < 0.5:
+                self.stats['errors'] += 1
+                status = self.rng.choice((429, 503))
+                return web.Response(status=status, headers={'Retry-After': '0'})
+            reset = True
+        headers = dict(headers or {})
+        start = 0
+        range_header = request.headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            start = int(range_header[6:].split('-')[0] or 0)
+            if start >= len(body):
+                return web.Response(status=416, headers={
+                    'Content-Range': 'bytes */{}'.format(len(body))})
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, len(body) - 1, len(body))
+            status = 206
+        data = body[start:]
+        if not self.bandwidth and not reset:
+            self.stats['bytes'] += len(data)
+            return web.Response(status=status, body=data, headers=headers)
+        headers['Content-Length'] = str(len(data))
+        resp = web.StreamResponse(status=status, headers=headers)
+        await resp.prepare(request)
+        stop = len(data) // 2 if reset else len(data)
+        for pos in range(0, stop, chunk_size):
+            chunk = data[pos:min(pos + chunk_size, stop)]
+            await resp.write(chunk)
+            self.stats['bytes'] += len(chunk)
+            if self.bandwidth:
+                await asyncio.sleep(len(chunk) / self.bandwidth)
+        if reset:
+            self.stats['resets'] += 1
+            request.transport.close()
+            return resp
+        await resp.write_eof()
+        return resp
+
+    async def top(self, request):
+        page = '<script>pixiv.context.token = "{}";pixiv.user.loggedIn = true;</script>'.format(
+            context_token)
+        return web.Response(text=page, content_type='text/html')
+
+    async def ranking(self, request):
+        page = int(request.query.get('p', 1))
+        content_type = {'illust': 0, 'manga': 1, 'ugoira': 2}.get(
+            request.query.get('content'))
+        ids = [illust_id for illust_id, illust_type in sorted(self.types.items())
+               if content_type is None or illust_type == content_type]
+        contents = [self.__entry(illust_id, rank)
+                    for rank, illust_id in enumerate(ids, 1)][(page - 1) * 50:page * 50]
+        if not contents:
+            body = {'error': 'No more pages'}
+        else:
+            body = {
+                'contents': contents,
+                'mode': request.query.get('mode'),
+                'date': request.query.get('date'),
+                'page': page,
+                'next': page + 1 if page * 50 < len(ids) else False,
+                'rank_total': len(ids)
+            }
+        return await self.__send(request, json.dumps(body).encode(),
+                                 headers={'Content-Type': 'application/json'})
+
+    async def illust_page(self, request):
+        illust_id = int(request.query['illust_id'])
+        mode = request.query.get('mode')
+        if mode == 'manga_big':
+            page = '<html><body><img src="{}/img-original/img/{}/{}_p{}.jpg"></body></html>'.format(
+                self.base, date_path, illust_id, request.query.get('page', 0))
+        elif self.types.get(illust_id) == 2:
+            info = {
+                'src': '{}/img-zip-ugoira/img/{}/{}_ugoira1920x1080.zip'.format(
+                    self.base, date_path, illust_id),
+                'frames': [{'file': name, 'delay': 50} for name, _ in self.frames]
+            }
+            page = '<script>pixiv.context.ugokuIllustFullscreenData  = {};</script>'.format(
+                json.dumps(info, separators=(',', ':')))
+        else:
+            page = '<html><body><div><img alt="" class="original-image" data-src="{}/img-original/img/{}/{}_p0.jpg"></div></body></html>'.format(
+                self.base, date_path, illust_id)
+        return await self.__send(request, page.encode(),
+                                 headers={'Content-Type': 'text/html'})
+
+    async def original(self, request):
+        return await self.__send(
+            request, self.__image(request.match_info['name']))
+
+    async def ugoira_zip(self, request):
+        illust_id = int(request.match_info['name'].split('_')[0])
+        return await self.__send(request, self.zip_data(illust_id))
+
+    async def stats_page(self, request):
+        return web.json_response(self.stats)
+
+    def app(self, base):
+        self.base = base
+        app = web.Application()
+        app.router.add_get('/', self.top)
+        app.router.add_get('/ranking.php', self.ranking)
+        app.router.add_get('/member_illust.php', self.illust_page)
+        app.router.add_get('/img-original/img/{date:.*}/{name}', self.original)
+        app.router.add_get('/img-zip-ugoira/img/{date:.*}/{name}', self.ugoira_zip)
+        app.router.add_get('/_stats', self.stats_page)
+        return app
+
+
+def run(port, **options):
+    base = 'http://127.0.0.1:{}'.format(port)
+    web.run_app(PixivStandIn(**options).app(base),
+                host='127.0.0.1', port=port, print=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='A local pixiv stand-in.')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--illusts', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds before each response')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='random extra seconds before each response')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='bytes per second of each response, 0 unlimited')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of responses failing with 429/503 or a reset')
+    args = parser.parse_args()
+    run(args.port, illusts=args.illusts, latency=args.latency,
+        jitter=args.jitter, bandwidth=args.bandwidth,
+        error_rate=args.error_rate)
+
+
+if __name__ == '__main__':
+    main()
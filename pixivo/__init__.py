@@ -1,5 +1,40 @@
-from .downloader import *
-from .pixiv_auth import *
-from .pixiv_rank import *
-from .database import *
-from .pixiv_search import *
+import importlib
+
+# the modules are only imported on first use, so a search does not pay for
+# aiohttp, imageio and friends
+_lazy_names = {
+    'AsyncPixivoDatabase': 'asyncdb',
+    'PixivoAuth': 'pixiv_auth',
+    'PixivoLogin': 'pixiv_auth',
+    'PixivoContext': 'context',
+    'PixivoDatabase': 'database',
+    'PixivoDownloader': 'downloader',
+    'PixivoQuery': 'query',
+    'PixivoRankSpider': 'pixiv_rank',
+    'PixivoSearcher': 'pixiv_search',
+    'PixivoBaseException': 'exceptions',
+    'PixivoAuthException': 'exceptions',
+    'PixivoSpiderException': 'exceptions',
+    'PixivoDBException': 'exceptions',
+    'PixivoDownloaderException': 'exceptions',
+    'PixivoNotFoundException': 'exceptions',
+    'PixivoExportException': 'exceptions',
+    'ResultExporter': 'export',
+    'load_config': 'config'
+}
+
+__all__ = list(_lazy_names)
+
+
+def __getattr__(name):
+    module_name = _lazy_names.get(name)
+    if module_name is None:
+        raise AttributeError(
+            'module {!r} has no attribute {!r}'.format(__name__, name))
+    value = getattr(importlib.import_module('.' + module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
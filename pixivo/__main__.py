@@ -0,0 +1,194 @@
+import argparse
+import sys
+
+from .config import load_config
+
+
+def _run(args, make_coro):
+    # aiohttp needs the loop running while the session is made
+    import asyncio
+
+    from .context import PixivoContext
+
+    async def main():
+        context = PixivoContext(load_config(args.config))
+        try:
+            await make_coro(context)
+        finally:
+            await context.close()
+    asyncio.get_event_loop().run_until_complete(main())
+
+
+def login(args):
+    import getpass
+
+    from .pixiv_auth import PixivoLogin
+
+    password = args.password or getpass.getpass('Password: ')
+    _run(args, lambda context: PixivoLogin(
+        args.pixiv_id, password, context).login())
+
+
+def rank(args):
+    from .pixiv_rank import PixivoRankSpider
+
+    _run(args, lambda context: PixivoRankSpider(context).getRankingList())
+
+
+def download(args):
+    from .downloader import PixivoDownloader
+
+    _run(args, lambda context: PixivoDownloader(context).start())
+
+
+def workers(args):
+    import time
+
+    from .database import PixivoDatabase
+
+    data_base = PixivoDatabase(load_config(args.config))
+    now = int(time.time())
+    print('{:<32}{:>8}{:>10}{:>9}{:>9}{:>9}  {}'.format(
+        'worker', 'files', 'MiB', 'files/s', 'MiB/s', 'claimed', 'state'))
+    for (worker_id, _, _, started, heartbeat, stopped,
+         files, bytes_count, claimed) in data_base.get_workers(args.limit):
+        elapsed = max((stopped or heartbeat) - started, 1)
+        if stopped:
+            state = 'stopped'
+        else:
+            state = 'seen {} s ago'.format(now - heartbeat)
+        print('{:<32}{:>8}{:>10.1f}{:>9.2f}{:>9.2f}{:>9}  {}'.format(
+            worker_id, files, bytes_count / 1048576, files / elapsed,
+            bytes_count / elapsed / 1048576, claimed, state))
+    data_base.close()
+
+
+def check(args):
+    # the plans of the queries in the crawler and downloader loops
+    from .database import PixivoDatabase
+    from .exceptions import PixivoDBException
+
+    data_base = PixivoDatabase(load_config(args.config))
+    try:
+        for name, details, indexed in data_base.explain_hot_queries():
+            print('{} {}'.format('ok ' if indexed else 'NO ', name))
+            for detail in details:
+                print('      {}'.format(detail))
+        data_base.check_query_plans()
+    except PixivoDBException as err:
+        print(err)
+        return 1
+    finally:
+        data_base.close()
+
+
+def search_json(args):
+    # one JSON object per line and no prompts, for scripts
+    import json
+
+    from .context import PixivoContext
+    from .query import PixivoQuery
+
+    query = PixivoQuery(PixivoContext(load_config(args.config)))
+    if args.illust is not None:
+        illust = query.illust(args.illust)
+        results = [illust] if illust else []
+    elif args.user_id is not None:
+        results = query.illusts_by_user(args.user_id, args.limit)
+    elif args.user is not None:
+        results = query.users_by_name(args.user, args.limit)
+    else:
+        results = query.illusts_by_keyword(
+            args.keyword, args.exact, args.limit)
+    for result in results:
+        item = result._asdict()
+        if 'tags' in item:
+            item['files'] = query.files(result.id)
+        sys.stdout.write(json.dumps(item, ensure_ascii=False) + '\n')
+
+
+def search(args):
+    if args.json:
+        return search_json(args)
+
+    from .context import PixivoContext
+    from .pixiv_search import PixivoSearcher
+
+    config = load_config(args.config)
+    if args.mode or args.archive:
+        config = dict(config)
+        config['export_mode'] = args.mode or config.get('export_mode')
+        config['export_archive'] = args.archive or config.get('export_archive')
+    context = PixivoContext(config)
+    searcher = PixivoSearcher(context)
+    if args.illust is not None:
+        searcher.searchIllustId(args.illust)
+    elif args.user_id is not None:
+        searcher.searchUserId(args.user_id)
+    elif args.user is not None:
+        searcher.searchUsername(args.user)
+    else:
+        searcher.searchTitleAndTags(args.keyword, args.exact)
+
+
+def main(argv=None):
+    from .export import export_modes
+
+    parser = argparse.ArgumentParser(
+        prog='pixivo', description='Crawl, download and search pixiv rankings.')
+    parser.add_argument('-c', '--config', default='_config.yml',
+                        help='the config file, default to _config.yml')
+    commands = parser.add_subparsers(dest='command')
+
+    login_parser = commands.add_parser('login', help='login and save the cookie')
+    login_parser.add_argument('pixiv_id')
+    login_parser.add_argument('-p', '--password',
+                              help='asked for when it is not given')
+    login_parser.set_defaults(func=login)
+
+    rank_parser = commands.add_parser(
+        'rank', help='crawl the rankings set in the config')
+    rank_parser.set_defaults(func=rank)
+
+    download_parser = commands.add_parser(
+        'download', help='download the files of the crawled illusts')
+    download_parser.set_defaults(func=download)
+
+    workers_parser = commands.add_parser(
+        'workers', help='show the throughput of the downloader processes')
+    workers_parser.add_argument('-l', '--limit', type=int, default=20,
+                                help='the latest workers shown, default to 20')
+    workers_parser.set_defaults(func=workers)
+
+    check_parser = commands.add_parser(
+        'check', help='check that the hot queries use an index')
+    check_parser.set_defaults(func=check)
+
+    search_parser = commands.add_parser(
+        'search', help='search the crawled illusts and users')
+    target = search_parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('-i', '--illust', type=int, help='an illust id')
+    target.add_argument('-u', '--user-id', type=int, help='a user id')
+    target.add_argument('-n', '--user', help='a part of a user name')
+    target.add_argument('-k', '--keyword', help='a tag or title keyword')
+    search_parser.add_argument('--exact', action='store_true',
+                               help='match whole tags only')
+    search_parser.add_argument('--json', action='store_true',
+                               help='print JSON lines without any prompt')
+    search_parser.add_argument('--limit', type=int,
+                               help='the most results printed with --json')
+    search_parser.add_argument('--mode', choices=export_modes,
+                               help='how the result files are exported')
+    search_parser.add_argument('--archive',
+                               help='export into this .zip or .tar instead')
+    search_parser.set_defaults(func=search)
+
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.print_help()
+        return 1
+    return args.func(args) or 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
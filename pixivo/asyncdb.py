@@ -0,0 +1,141 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+
+from . import metrics
+from .config import load_config
+from .database import PixivoDatabase
+
+
+class AsyncPixivoDatabase:
+    # a PixivoDatabase owned by one thread, so the event loop never waits on
+    # sqlite; calls are queued in order, the writes queued while a commit
+    # runs are committed together once the queue is drained
+    #
+    #   count = await data_base.count_file(illust_id)
+    #   data_base.post('set_file_error', ref, error)
+
+    def __init__(self, config=None):
+        self.config = config if config is not None else load_config()
+        self.queue = queue.Queue()
+        # set once the thread has stopped, calls then fail at once
+        self.error = None
+        self.lock = threading.Lock()
+        ready = Future()
+        self.thread = threading.Thread(
+            target=self.__run, args=(ready,), name='pixivo-db', daemon=True)
+        self.thread.start()
+        # errors of opening or migrating the database are raised here
+        ready.result()
+        metrics.queue_depth.set_function(self.queue.qsize, 'db')
+
+    def __run(self, ready):
+        try:
+            data_base = PixivoDatabase(self.config)
+        except Exception as err:
+            ready.set_exception(err)
+            return
+        ready.set_result(None)
+        error = RuntimeError('The database is closed')
+        try:
+            with data_base.batch():
+                while True:
+                    call = self.queue.get()
+                    if call is None:
+                        break
+                    self.__call(data_base, *call)
+                    if self.queue.empty() and data_base.batch_pending:
+                        self.__flush(data_base)
+        except Exception as err:
+            print('Database thread failed: {}'.format(err))
+            error = RuntimeError('The database thread failed: {}'.format(err))
+        finally:
+            self.__stop(error)
+            try:
+                data_base.close()
+            except sqlite3.Error as err:
+                print('Database close failed: {}'.format(err))
+
+    @staticmethod
+    def __flush(data_base):
+        try:
+            data_base.flush()
+        except sqlite3.Error as err:
+            # e.g. the database is locked by another process for longer than
+            # db_timeout; the batched writes are lost, the next calls are
+            # still served
+            print('Database commit failed: {}'.format(err))
+            data_base.rollback()
+
+    def __stop(self, error):
+        # nothing is left waiting for a thread that is gone
+        with self.lock:
+            self.error = error
+        while True:
+            try:
+                call = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if call is not None and call[0] is not None and \
+                    call[0].set_running_or_notify_cancel():
+                call[0].set_exception(error)
+
+    def __put(self, call):
+        with self.lock:
+            if self.error is None:
+                self.queue.put(call)
+                return True
+        return False
+
+    @staticmethod
+    def __call(data_base, future, name, args, kwargs):
+        if future is not None and not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = getattr(data_base, name)(*args, **kwargs)
+        except Exception as err:
+            if future is None:
+                print('Database {} failed: {}'.format(name, err))
+            else:
+                future.set_exception(err)
+            return
+        if future is not None:
+            future.set_result(result)
+
+    def __check(self, name):
+        if name.startswith('_') or \
+                not callable(getattr(PixivoDatabase, name, None)):
+            raise AttributeError(
+                'PixivoDatabase has no method {!r}'.format(name))
+        if self.thread is None:
+            raise RuntimeError('The database is closed')
+
+    def submit(self, name, *args, **kwargs):
+        # a concurrent future of the method, for callers outside the loop
+        self.__check(name)
+        future = Future()
+        if not self.__put((future, name, args, kwargs)):
+            future.set_exception(self.error)
+        return future
+
+    def post(self, name, *args, **kwargs):
+        # a write whose result is not waited for, errors are printed
+        self.__check(name)
+        if not self.__put((None, name, args, kwargs)):
+            print('Database {} failed: {}'.format(name, self.error))
+
+    def __getattr__(self, name):
+        self.__check(name)
+
+        def call(*args, **kwargs):
+            return asyncio.wrap_future(self.submit(name, *args, **kwargs))
+        return call
+
+    def close(self):
+        # waits for the queued calls and the last commit
+        if self.thread is not None:
+            self.__put(None)
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,18 @@
+import os
+
+import yaml
+
+_configs = {}
+
+
+def load_config(path='_config.yml'):
+    # parsed once per file, again only when the file has changed
+    path = os.path.abspath(path)
+    mtime = os.path.getmtime(path)
+    cached = _configs.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path) as fp:
+        config = yaml.safe_load(fp)
+    _configs[path] = (mtime, config)
+    return config
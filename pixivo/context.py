@@ -0,0 +1,48 @@
+from .config import load_config
+from .database import PixivoDatabase
+
+
+class PixivoContext:
+    # one config, one pooled http session and one database handle, shared by
+    # the auth, spider, downloader and searcher of a run
+
+    def __init__(self, config=None):
+        self.config = config if config is not None else load_config()
+        self.__http = None
+        self.__data_base = None
+        self.__async_data_base = None
+
+    @property
+    def http(self):
+        if self.__http is None:
+            # aiohttp is only imported by the components that go online
+            from .httpclient import HttpSession
+
+            self.__http = HttpSession(self.config)
+        return self.__http
+
+    @property
+    def data_base(self):
+        if self.__data_base is None:
+            self.__data_base = PixivoDatabase(self.config)
+        return self.__data_base
+
+    @property
+    def async_data_base(self):
+        # for the components on the event loop, see AsyncPixivoDatabase
+        if self.__async_data_base is None:
+            from .asyncdb import AsyncPixivoDatabase
+
+            self.__async_data_base = AsyncPixivoDatabase(self.config)
+        return self.__async_data_base
+
+    async def close(self):
+        if self.__http is not None:
+            await self.__http.close()
+            self.__http = None
+        if self.__data_base is not None:
+            self.__data_base.close()
+            self.__data_base = None
+        if self.__async_data_base is not None:
+            self.__async_data_base.close()
+            self.__async_data_base = None
@@ -2,27 +2,318 @@ import json
 import os
 import sqlite3
 import time
+from contextlib import contextmanager
 
-import yaml
-
+from . import metrics
+from .config import load_config
 from .exceptions import PixivoDBException
 
+# trigram tokens let FTS find any substring of three or more characters,
+# also in unspaced Japanese text; shorter keywords match tag and name
+# prefixes only
+fts_trigram = sqlite3.sqlite_version_info >= (3, 34, 0)
+fts_tokenize = 'trigram' if fts_trigram else 'unicode61'
+
+search_tables = ['ILLUST_FTS', 'USER_FTS', 'TAG_FTS']
+search_triggers = ['ILLUST_INSERT', 'ILLUST_UPDATE_TITLE', 'ILLUST_UPDATE_TEXT',
+                   'ILLUST_DELETE', 'USER_INSERT', 'USER_UPDATE', 'USER_DELETE',
+                   'TAG_INSERT']
+
+
+def _search_schema(tokenize):
+    # the FTS tables, one per search_tables entry, then their triggers
+    return [
+        '''CREATE VIRTUAL TABLE ILLUST_FTS
+        USING fts5(TITLE, content='ILLUST', content_rowid='ID',
+                   tokenize='{}');'''.format(tokenize),
+        '''CREATE VIRTUAL TABLE USER_FTS
+        USING fts5(NAME, content='USER', content_rowid='ID',
+                   tokenize='{}');'''.format(tokenize),
+        '''CREATE VIRTUAL TABLE TAG_FTS
+        USING fts5(NAME, content='TAG', content_rowid='ID',
+                   tokenize='{}');'''.format(tokenize),
+        '''CREATE TRIGGER ILLUST_INSERT AFTER INSERT ON ILLUST BEGIN
+            INSERT INTO ILLUST_FTS (ROWID, TITLE) VALUES (new.ID, new.TITLE);
+            INSERT OR IGNORE INTO ILLUST_TAG (IID, TAG)
+            SELECT new.ID, value FROM json_each(new.TAGS);
+        END;''',
+        '''CREATE TRIGGER ILLUST_UPDATE_TITLE AFTER UPDATE OF TITLE ON ILLUST
+        WHEN old.TITLE IS NOT new.TITLE BEGIN
+            INSERT INTO ILLUST_FTS (ILLUST_FTS, ROWID, TITLE)
+            VALUES ('delete', old.ID, old.TITLE);
+            INSERT INTO ILLUST_FTS (ROWID, TITLE) VALUES (new.ID, new.TITLE);
+        END;''',
+        '''CREATE TRIGGER ILLUST_DELETE AFTER DELETE ON ILLUST BEGIN
+            INSERT INTO ILLUST_FTS (ILLUST_FTS, ROWID, TITLE)
+            VALUES ('delete', old.ID, old.TITLE);
+            DELETE FROM ILLUST_TAG WHERE IID = old.ID;
+        END;''',
+        '''CREATE TRIGGER USER_INSERT AFTER INSERT ON USER BEGIN
+            INSERT INTO USER_FTS (ROWID, NAME) VALUES (new.ID, new.NAME);
+        END;''',
+        '''CREATE TRIGGER USER_UPDATE AFTER UPDATE OF NAME ON USER
+        WHEN old.NAME IS NOT new.NAME BEGIN
+            INSERT INTO USER_FTS (USER_FTS, ROWID, NAME)
+            VALUES ('delete', old.ID, old.NAME);
+            INSERT INTO USER_FTS (ROWID, NAME) VALUES (new.ID, new.NAME);
+        END;''',
+        '''CREATE TRIGGER USER_DELETE AFTER DELETE ON USER BEGIN
+            INSERT INTO USER_FTS (USER_FTS, ROWID, NAME)
+            VALUES ('delete', old.ID, old.NAME);
+        END;''',
+        '''CREATE TRIGGER TAG_INSERT AFTER INSERT ON TAG BEGIN
+            INSERT INTO TAG_FTS (ROWID, NAME) VALUES (new.ID, new.NAME);
+        END;'''
+    ] + ["INSERT INTO {0} ({0}) VALUES ('rebuild');".format(table)
+         for table in search_tables]
 
-class PixivoDatabase:
 
-    def __init__(self):
-        with open('_config.yml') as fp:
-            config = yaml.load(fp)
-            self.path = config['path']
-            self.db_path = os.path.join(self.path, 'data.db')
+class PixivoDatabase:
+    # schema changes applied on top of the base tables, one list of
+    # statements per version; PRAGMA user_version is the applied count
+    migrations = [
+        [
+            'CREATE INDEX IF NOT EXISTS IDX_FILE_STATUS ON FILE (STATUS, REF);',
+            'CREATE INDEX IF NOT EXISTS IDX_FILE_IID ON FILE (IID, STATUS);',
+            'CREATE INDEX IF NOT EXISTS IDX_ILLUST_STATUS ON ILLUST (STATUS);',
+            'CREATE INDEX IF NOT EXISTS IDX_ILLUST_USER ON ILLUST (USER, RATING);'
+        ],
+        [
+            '''CREATE TABLE IF NOT EXISTS ILLUST_TAG(
+                IID         INTEGER,
+                TAG         TEXT,
+                PRIMARY KEY (IID, TAG)
+            ) WITHOUT ROWID;''',
+            'CREATE INDEX IF NOT EXISTS IDX_ILLUST_TAG_TAG ON ILLUST_TAG (TAG);',
+            '''CREATE VIRTUAL TABLE IF NOT EXISTS ILLUST_FTS
+            USING fts5(TITLE, content='ILLUST', content_rowid='ID');''',
+            '''CREATE VIRTUAL TABLE IF NOT EXISTS USER_FTS
+            USING fts5(NAME, content='USER', content_rowid='ID');''',
+            '''CREATE TRIGGER IF NOT EXISTS ILLUST_INSERT AFTER INSERT ON ILLUST BEGIN
+                INSERT INTO ILLUST_FTS (ROWID, TITLE) VALUES (new.ID, new.TITLE);
+                INSERT OR IGNORE INTO ILLUST_TAG (IID, TAG)
+                SELECT new.ID, value FROM json_each(new.TAGS);
+            END;''',
+            '''CREATE TRIGGER IF NOT EXISTS ILLUST_UPDATE_TITLE AFTER UPDATE OF TITLE ON ILLUST
+            WHEN old.TITLE IS NOT new.TITLE BEGIN
+                INSERT INTO ILLUST_FTS (ILLUST_FTS, ROWID, TITLE)
+                VALUES ('delete', old.ID, old.TITLE);
+                INSERT INTO ILLUST_FTS (ROWID, TITLE) VALUES (new.ID, new.TITLE);
+            END;''',
+            '''CREATE TRIGGER IF NOT EXISTS ILLUST_UPDATE_TAGS AFTER UPDATE OF TAGS ON ILLUST
+            WHEN old.TAGS IS NOT new.TAGS BEGIN
+                DELETE FROM ILLUST_TAG WHERE IID = old.ID;
+                INSERT OR IGNORE INTO ILLUST_TAG (IID, TAG)
+                SELECT new.ID, value FROM json_each(new.TAGS);
+            END;''',
+            '''CREATE TRIGGER IF NOT EXISTS ILLUST_DELETE AFTER DELETE ON ILLUST BEGIN
+                INSERT INTO ILLUST_FTS (ILLUST_FTS, ROWID, TITLE)
+                VALUES ('delete', old.ID, old.TITLE);
+                DELETE FROM ILLUST_TAG WHERE IID = old.ID;
+            END;''',
+            '''CREATE TRIGGER IF NOT EXISTS USER_INSERT AFTER INSERT ON USER BEGIN
+                INSERT INTO USER_FTS (ROWID, NAME) VALUES (new.ID, new.NAME);
+            END;''',
+            '''CREATE TRIGGER IF NOT EXISTS USER_UPDATE AFTER UPDATE OF NAME ON USER
+            WHEN old.NAME IS NOT new.NAME BEGIN
+                INSERT INTO USER_FTS (USER_FTS, ROWID, NAME)
+                VALUES ('delete', old.ID, old.NAME);
+                INSERT INTO USER_FTS (ROWID, NAME) VALUES (new.ID, new.NAME);
+            END;''',
+            '''CREATE TRIGGER IF NOT EXISTS USER_DELETE AFTER DELETE ON USER BEGIN
+                INSERT INTO USER_FTS (USER_FTS, ROWID, NAME)
+                VALUES ('delete', old.ID, old.NAME);
+            END;''',
+            "INSERT INTO ILLUST_FTS (ILLUST_FTS) VALUES ('rebuild');",
+            "INSERT INTO USER_FTS (USER_FTS) VALUES ('rebuild');",
+            '''INSERT OR IGNORE INTO ILLUST_TAG (IID, TAG)
+            SELECT ILLUST.ID, json_each.value FROM ILLUST, json_each(ILLUST.TAGS);'''
+        ],
+        [
+            '''CREATE TABLE IF NOT EXISTS RANK_PAGE(
+                MODE        TEXT,
+                CONTENT     TEXT,
+                DATE        TEXT,
+                PAGE        INTEGER,
+                TOTAL       INTEGER,
+                TIME        INTEGER,
+                PRIMARY KEY (MODE, CONTENT, DATE, PAGE)
+            ) WITHOUT ROWID;'''
+        ],
+        [
+            'ALTER TABLE FILE ADD COLUMN HASH TEXT;',
+            '''CREATE TABLE IF NOT EXISTS BLOB(
+                HASH        TEXT PRIMARY KEY,
+                PATH        TEXT,
+                SIZE        INTEGER
+            ) WITHOUT ROWID;'''
+        ],
+        [
+            'ALTER TABLE ILLUST ADD COLUMN URL TEXT;'
+        ],
+        [
+            'ALTER TABLE FILE ADD COLUMN ERROR TEXT;'
+        ],
+        [
+            # STATUS 3 is a file claimed by the OWNER worker until the LEASE
+            'ALTER TABLE FILE ADD COLUMN OWNER TEXT;',
+            'ALTER TABLE FILE ADD COLUMN LEASE INTEGER;',
+            'CREATE INDEX IF NOT EXISTS IDX_FILE_LEASE ON FILE (STATUS, LEASE);',
+            'CREATE INDEX IF NOT EXISTS IDX_FILE_OWNER ON FILE (OWNER, STATUS);',
+            '''CREATE TABLE IF NOT EXISTS WORKER(
+                ID          TEXT PRIMARY KEY,
+                HOST        TEXT,
+                PID         INTEGER,
+                STARTED     INTEGER,
+                HEARTBEAT   INTEGER,
+                STOPPED     INTEGER,
+                FILES       INTEGER DEFAULT 0,
+                BYTES       INTEGER DEFAULT 0
+            ) WITHOUT ROWID;'''
+        ],
+        [
+            # the FTS tables are built by __update_search_schema with the
+            # tokenizer of the SQLite in use
+            'DROP TRIGGER IF EXISTS ILLUST_INSERT;',
+            'DROP TRIGGER IF EXISTS ILLUST_UPDATE_TITLE;',
+            'DROP TRIGGER IF EXISTS ILLUST_DELETE;',
+            'DROP TABLE IF EXISTS ILLUST_FTS;',
+            'DROP TABLE IF EXISTS USER_FTS;'
+        ],
+        [
+            # every distinct tag once, so a keyword is matched against each
+            # tag alone and never across two of them
+            '''CREATE TABLE IF NOT EXISTS TAG(
+                ID          INTEGER PRIMARY KEY,
+                NAME        TEXT UNIQUE
+            );''',
+            '''CREATE TRIGGER IF NOT EXISTS ILLUST_TAG_INSERT AFTER INSERT ON ILLUST_TAG BEGIN
+                INSERT OR IGNORE INTO TAG (NAME) VALUES (new.TAG);
+            END;''',
+            'INSERT OR IGNORE INTO TAG (NAME) SELECT DISTINCT TAG FROM ILLUST_TAG;',
+            'CREATE INDEX IF NOT EXISTS IDX_USER_NAME ON USER (NAME);'
+        ]
+    ]
+
+    # queries run in the crawler and downloader loops, shared with
+    # hot_queries so their plans are checked as they are run
+    expired_files_sql = 'SELECT IID, TYPE, REF, URL, PATH FROM FILE WHERE STATUS = 3 AND LEASE < ? AND OWNER IS NOT ? LIMIT ?;'
+    unset_files_sql = 'SELECT IID, TYPE, REF, URL, PATH FROM FILE WHERE STATUS = 0 AND REF > ? ORDER BY REF LIMIT ?;'
+    count_unset_files_sql = 'SELECT (SELECT COUNT(*) FROM FILE WHERE STATUS = 0) + (SELECT COUNT(*) FROM FILE WHERE STATUS = 3 AND LEASE < ?);'
+    renew_leases_sql = 'UPDATE FILE SET LEASE = ? WHERE OWNER = ? AND STATUS = 3;'
+    count_file_sql = 'SELECT COUNT(*) FROM FILE WHERE STATUS IN (0, 3) AND IID=?;'
+    files_for_illust_sql = 'SELECT PATH FROM FILE WHERE IID=? AND STATUS = 1;'
+    unset_illusts_sql = 'SELECT MAX(ID) FROM (SELECT ID FROM ILLUST WHERE STATUS = 0 AND ID > ? ORDER BY ID LIMIT ?);'
+    illusts_by_user_sql = '''SELECT ID,TITLE,DATE,PAGE,TAGS,RATING,VIEW FROM ILLUST
+                WHERE USER=?
+                ORDER BY RATING DESC, ID DESC LIMIT ?;'''
+    illusts_by_user_after_sql = '''SELECT ID,TITLE,DATE,PAGE,TAGS,RATING,VIEW FROM ILLUST
+                WHERE USER=? AND (RATING, ID) < (?, ?)
+                ORDER BY RATING DESC, ID DESC LIMIT ?;'''
+
+    # with sample params, see check_query_plans()
+    hot_queries = [
+        ('claim_files expired', expired_files_sql, (0, '', 10)),
+        ('claim_files unset', unset_files_sql, ('', 10)),
+        ('count_unset_files', count_unset_files_sql, (0,)),
+        ('heartbeat', renew_leases_sql, (0, '')),
+        ('count_file', count_file_sql, (0,)),
+        ('get_files_for_illust', files_for_illust_sql, (0,)),
+        ('prepare_files', unset_illusts_sql, (0, 10000)),
+        ('get_illust_info_by_user_id', illusts_by_user_sql, (0, 10)),
+        ('get_illust_info_by_user_id after', illusts_by_user_after_sql,
+         (0, 0, 0, 10))
+    ]
+
+    def __init__(self, config=None):
+        if config is None:
+            config = load_config()
+        self.path = config['path']
+        self.db_path = os.path.join(self.path, 'data.db')
+        journal_mode = config.get('db_journal_mode')
+        synchronous = config.get('db_synchronous')
+        self.batch_size = config.get('db_batch_size') or 500
+        self.batch_interval = config.get('db_batch_interval') or 2
+        # other downloader processes may hold the write lock meanwhile
+        timeout = config.get('db_timeout') or 60
 
         self.timestamp = int(time.time())
 
-        self.db_conn = sqlite3.connect(self.db_path)
+        self.db_conn = sqlite3.connect(self.db_path, timeout=timeout)
         self.db_cur = self.db_conn.cursor()
 
+        # write statements of this connection, see generation()
+        self.writes = 0
+        self.batch_depth = 0
+        self.batch_pending = 0
+        self.batch_start = time.time()
+
+        self.__set_pragmas(journal_mode, synchronous)
         self.__init_db()
 
+    def __set_pragmas(self, journal_mode, synchronous):
+        if journal_mode:
+            journal_mode = str(journal_mode).upper()
+            if journal_mode not in ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'):
+                raise PixivoDBException(
+                    'Unknown journal mode "%s"!' % journal_mode)
+            self.db_cur.execute('PRAGMA journal_mode = %s;' % journal_mode)
+        if synchronous:
+            synchronous = str(synchronous).upper()
+            if synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+                raise PixivoDBException(
+                    'Unknown synchronous setting "%s"!' % synchronous)
+            self.db_cur.execute('PRAGMA synchronous = %s;' % synchronous)
+
+    def __commit(self):
+        self.writes += 1
+        metrics.db_writes.inc()
+        if not self.batch_depth:
+            self.__timed_commit()
+            return
+        self.batch_pending += 1
+        metrics.db_pending.set(self.batch_pending)
+        if self.batch_pending >= self.batch_size or \
+                time.time() - self.batch_start >= self.batch_interval:
+            self.flush()
+
+    def __timed_commit(self):
+        st = time.time()
+        self.db_conn.commit()
+        metrics.db_commit_seconds.observe(time.time() - st)
+
+    def __commit_now(self):
+        # claims and leases must be seen by the other workers at once
+        self.writes += 1
+        metrics.db_writes.inc()
+        self.flush()
+
+    def flush(self):
+        self.__timed_commit()
+        self.batch_pending = 0
+        metrics.db_pending.set(0)
+        self.batch_start = time.time()
+
+    def rollback(self):
+        # drops the writes not committed yet
+        self.db_conn.rollback()
+        self.batch_pending = 0
+        metrics.db_pending.set(0)
+        self.batch_start = time.time()
+
+    @contextmanager
+    def batch(self):
+        if not self.batch_depth:
+            self.batch_pending = 0
+            self.batch_start = time.time()
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                self.flush()
+
     def __init_db(self):
         if not self.__exist_table('ILLUST'):
             self.db_cur.execute('''
@@ -57,6 +348,100 @@ class PixivoDatabase:
                 PATH        TEXT
             );''')
         self.db_conn.commit()
+        self.__migrate()
+        self.__update_search_schema()
+
+    def __migrate(self):
+        self.db_cur.execute('PRAGMA user_version;')
+        version = self.db_cur.fetchone()[0]
+        for statements in self.migrations[version:]:
+            try:
+                self.db_cur.execute('BEGIN;')
+                for statement in statements:
+                    self.db_cur.execute(statement)
+                version += 1
+                self.db_cur.execute('PRAGMA user_version = %d;' % version)
+                self.db_conn.commit()
+            except sqlite3.Error as err:
+                self.db_conn.rollback()
+                raise PixivoDBException(
+                    'Migration to version {} failed: {}'.format(version + 1, err))
+
+    def __update_search_schema(self):
+        # a data.db may have been built by another SQLite, whose tokenizer
+        # this one would not use or can't load at all
+        statements = _search_schema(fts_tokenize)
+        self.db_cur.execute(
+            "SELECT NAME, SQL FROM SQLITE_MASTER WHERE TYPE = 'table' AND NAME IN ({});".format(
+                ','.join('?' * len(search_tables))),
+            search_tables)
+        built = dict(self.db_cur.fetchall())
+        if all(self.__schema_text(built.get(table)) == self.__schema_text(sql)
+               for table, sql in zip(search_tables, statements)):
+            return
+        try:
+            self.db_cur.execute('BEGIN IMMEDIATE;')
+            for trigger in search_triggers:
+                self.db_cur.execute('DROP TRIGGER IF EXISTS {};'.format(trigger))
+            for table in search_tables:
+                self.__drop_search_table(table)
+            for statement in statements:
+                self.db_cur.execute(statement)
+            self.db_conn.commit()
+        except sqlite3.Error as err:
+            self.db_conn.rollback()
+            raise PixivoDBException(
+                'Building the search tables failed: {}'.format(err))
+
+    @staticmethod
+    def __schema_text(sql):
+        # as SQLITE_MASTER keeps it, without the semicolon
+        return ' '.join((sql or '').rstrip(';').split())
+
+    def __drop_search_table(self, table):
+        try:
+            self.db_cur.execute('DROP TABLE IF EXISTS {};'.format(table))
+        except sqlite3.OperationalError:
+            # its tokenizer is missing here, and SQLite can't drop an FTS
+            # table it can't load: the table is taken out of the schema,
+            # then its shadow tables are dropped
+            self.db_cur.execute('PRAGMA schema_version;')
+            version = self.db_cur.fetchone()[0]
+            self.db_cur.execute('PRAGMA writable_schema = ON;')
+            self.db_cur.execute(
+                "DELETE FROM SQLITE_MASTER WHERE TYPE = 'table' AND NAME = ?;",
+                (table,))
+            self.db_cur.execute('PRAGMA schema_version = %d;' % (version + 1))
+            self.db_cur.execute('PRAGMA writable_schema = OFF;')
+            for shadow in ('data', 'idx', 'content', 'docsize', 'config'):
+                self.db_cur.execute(
+                    'DROP TABLE IF EXISTS {}_{};'.format(table, shadow))
+
+    def generation(self):
+        # changes whenever the data may have changed: with the writes of this
+        # connection, and with PRAGMA data_version on commits of others
+        self.db_cur.execute('PRAGMA data_version;')
+        return self.writes, self.db_cur.fetchone()[0]
+
+    def explain_hot_queries(self):
+        plans = []
+        for name, query, params in self.hot_queries:
+            self.db_cur.execute('EXPLAIN QUERY PLAN ' + query, params)
+            details = [row[-1] for row in self.db_cur.fetchall()]
+            indexed = not any(
+                (detail.startswith('SCAN') and 'INDEX' not in detail and
+                 detail != 'SCAN CONSTANT ROW') or
+                'TEMP B-TREE' in detail
+                for detail in details)
+            plans.append((name, details, indexed))
+        return plans
+
+    def check_query_plans(self):
+        unindexed = [name for name, _, indexed in self.explain_hot_queries()
+                     if not indexed]
+        if unindexed:
+            raise PixivoDBException(
+                'Queries without index: {}'.format(', '.join(unindexed)))
 
     def __exist_table(self, table_name):
         self.db_cur.execute(
@@ -71,22 +456,27 @@ class PixivoDatabase:
         ''', (illust_id,))
         return self.db_cur.fetchone()[0] != 0
 
+    def __illust_row(self, illust_info):
+        return (
+            int(illust_info['illust_id']),
+            int(illust_info['illust_type']),
+            illust_info['title'],
+            illust_info['illust_upload_timestamp'],
+            int(illust_info['illust_page_count']),
+            illust_info['user_id'],
+            json.dumps(illust_info['tags'], ensure_ascii=False),
+            illust_info['rating_count'],
+            illust_info['view_count'],
+            self.timestamp,
+            illust_info.get('url')
+        )
+
     def insert_illust(self, illust_info):
-        illust_id = illust_info['illust_id']
-        illust_type = int(illust_info['illust_type'])
-        illust_title = illust_info['title']
-        timestamp = illust_info['illust_upload_timestamp']
-        page_count = int(illust_info['illust_page_count'])
-        user_id = illust_info['user_id']
-        tags = json.dumps(illust_info['tags'], ensure_ascii=False)
-        rating_count = illust_info['rating_count']
-        view_count = illust_info['view_count']
         self.db_cur.execute('''
-        INSERT INTO ILLUST (ID,TYPE,TITLE,DATE,PAGE,USER,TAGS,RATING,VIEW,TIME)
-        VALUES (?,?,?,?,?,?,?,?,?,?);
-        ''', (illust_id, illust_type, illust_title, timestamp, page_count,
-              user_id, tags, rating_count, view_count, self.timestamp))
-        self.db_conn.commit()
+        INSERT INTO ILLUST (ID,TYPE,TITLE,DATE,PAGE,USER,TAGS,RATING,VIEW,TIME,URL)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?);
+        ''', self.__illust_row(illust_info))
+        self.__commit()
 
     def update_illust(self, illust_id, illust_info):
         illust_type = int(illust_info['illust_type'])
@@ -97,27 +487,122 @@ class PixivoDatabase:
         user_id = illust_info['user_id']
         rating_count = illust_info['rating_count']
         view_count = illust_info['view_count']
+        url = illust_info.get('url')
         self.db_cur.execute(
-            'UPDATE ILLUST SET TYPE = ?,TITLE = ?,DATE = ?,PAGE = ?,USER = ?,TAGS = ?,RATING = ?,VIEW = ?, TIME = ? WHERE ID = ?;',
+            'UPDATE ILLUST SET TYPE = ?,TITLE = ?,DATE = ?,PAGE = ?,USER = ?,TAGS = ?,RATING = ?,VIEW = ?, TIME = ?, URL = COALESCE(?, URL) WHERE ID = ?;',
             (illust_type, illust_title, timestamp, page_count, user_id,
-             tags, rating_count, view_count, self.timestamp, illust_id)
+             tags, rating_count, view_count, self.timestamp, url, illust_id)
         )
-        self.db_conn.commit()
+        self.__commit()
+
+    def upsert_ranking(self, contents):
+        if not contents:
+            return [], []
+        illust_rows = [self.__illust_row(illust) for illust in contents]
+        illust_ids = [row[0] for row in illust_rows]
+        self.db_cur.execute(
+            'SELECT ID FROM ILLUST WHERE ID IN ({});'.format(
+                ','.join('?' * len(illust_ids))),
+            illust_ids
+        )
+        existed = set(row[0] for row in self.db_cur.fetchall())
+        users = dict(
+            (illust['user_id'], illust['user_name']) for illust in contents)
+        self.db_cur.executemany('''
+        INSERT INTO ILLUST (ID,TYPE,TITLE,DATE,PAGE,USER,TAGS,RATING,VIEW,TIME,URL)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?)
+        ON CONFLICT(ID) DO UPDATE SET
+            TYPE = excluded.TYPE, TITLE = excluded.TITLE, DATE = excluded.DATE,
+            PAGE = excluded.PAGE, USER = excluded.USER, TAGS = excluded.TAGS,
+            RATING = excluded.RATING, VIEW = excluded.VIEW, TIME = excluded.TIME,
+            URL = COALESCE(excluded.URL, URL);
+        ''', illust_rows)
+        self.db_cur.executemany('''
+        INSERT INTO USER (ID,NAME,TIME) VALUES (?,?,?)
+        ON CONFLICT(ID) DO UPDATE SET NAME = excluded.NAME, TIME = excluded.TIME;
+        ''', [(user_id, user_name, self.timestamp)
+              for user_id, user_name in users.items()])
+        self.__commit()
+        new_ids = [iid for iid in illust_ids if iid not in existed]
+        updated_ids = [iid for iid in illust_ids if iid in existed]
+        return new_ids, updated_ids
+
+    def get_rank_pages(self, mode, content_type, date_str):
+        self.db_cur.execute(
+            'SELECT PAGE, TOTAL FROM RANK_PAGE WHERE MODE=? AND CONTENT=? AND DATE=?;',
+            (mode, content_type, date_str)
+        )
+        res = self.db_cur.fetchall()
+        pages = set(row[0] for row in res)
+        totals = [row[1] for row in res if row[1]]
+        return pages, max(totals) if totals else None
+
+    def set_rank_page(self, mode, content_type, date_str, page, rank_total):
+        self.db_cur.execute(
+            'INSERT OR REPLACE INTO RANK_PAGE (MODE,CONTENT,DATE,PAGE,TOTAL,TIME) VALUES (?,?,?,?,?,?);',
+            (mode, content_type, date_str, page, rank_total, self.timestamp)
+        )
+        self.__commit()
 
     def set_illust_status(self, illust_id, status=1):
         self.db_cur.execute(
             'UPDATE ILLUST SET STATUS = ? WHERE ID = ?;',
             (status, illust_id)
         )
-        self.db_conn.commit()
-
-    def get_unset_illust(self):
-        limit = 100
+        self.__commit()
+
+    def prepare_files(self, after=0, limit=10000):
+        # FILE rows of the next unset illusts after the ID, all set-wise:
+        # one medium page per illust or ugoira, one manga_big page per page
+        self.db_cur.execute(self.unset_illusts_sql, (after, limit))
+        last_id = self.db_cur.fetchone()[0]
+        if last_id is None:
+            return None, 0, 0, []
+        self.db_cur.execute('SELECT IFNULL(MAX(ROWID), 0) FROM FILE;')
+        last_row = self.db_cur.fetchone()[0]
+        # rowcount is not set for a statement starting with WITH
+        changes = self.db_conn.total_changes
+        self.db_cur.execute('''
+        WITH RECURSIVE
+        UNSET AS (
+            SELECT ID, TYPE, PAGE,
+                TYPE = 1 OR (TYPE = 0 AND PAGE > 1) AS MANGA
+            FROM ILLUST
+            WHERE STATUS = 0 AND ID > ? AND ID <= ? AND TYPE IN (0, 1, 2)
+                AND NOT EXISTS (SELECT 1 FROM FILE WHERE IID = ILLUST.ID)
+        ),
+        PAGES(N) AS (
+            SELECT 0
+            UNION ALL
+            SELECT N + 1 FROM PAGES
+            WHERE N + 1 < (SELECT MAX(PAGE) FROM UNSET)
+        )
+        INSERT OR IGNORE INTO FILE (IID, TYPE, REF)
+        SELECT ID,
+            CASE WHEN MANGA THEN 1 ELSE TYPE END,
+            CASE WHEN MANGA
+                THEN 'https://www.pixiv.net/member_illust.php?mode=manga_big&illust_id=' || ID || '&page=' || N
+                ELSE 'https://www.pixiv.net/member_illust.php?mode=medium&illust_id=' || ID
+            END
+        FROM UNSET JOIN PAGES ON N < CASE WHEN MANGA THEN PAGE ELSE 1 END
+        ORDER BY ID, N;
+        ''', (after, last_id))
+        file_count = self.db_conn.total_changes - changes
         self.db_cur.execute(
-            'SELECT ID, TYPE, PAGE FROM ILLUST WHERE STATUS = 0 LIMIT ?;',
-            (limit,)
+            'UPDATE ILLUST SET STATUS = 1 WHERE STATUS = 0 AND ID > ? AND ID <= ?;',
+            (after, last_id)
         )
-        return self.db_cur.fetchall()
+        illust_count = self.db_cur.rowcount
+        # the new files whose source url can be derived from the ranking
+        self.db_cur.execute('''
+        SELECT F.IID, F.TYPE, F.REF, I.URL FROM FILE F
+        JOIN ILLUST I ON I.ID = F.IID
+        WHERE F.ROWID > ? AND F.TYPE IN (0, 1) AND I.URL IS NOT NULL
+        ORDER BY F.ROWID;
+        ''', (last_row,))
+        derivable = self.db_cur.fetchall()
+        self.__commit()
+        return last_id, illust_count, file_count, derivable
 
     def exist_user(self, user_id):
         self.db_cur.execute(
@@ -129,14 +614,14 @@ class PixivoDatabase:
             'INSERT INTO USER (ID,NAME,TIME) VALUES (?,?,?);',
             (user_id, user_name, self.timestamp)
         )
-        self.db_conn.commit()
+        self.__commit()
 
     def update_user(self, user_id, user_name):
         self.db_cur.execute(
             'UPDATE USER SET NAME = ?, TIME = ? WHERE ID = ?;',
             (user_name, self.timestamp, user_id)
         )
-        self.db_conn.commit()
+        self.__commit()
 
     def exsit_file(self, illust_id):
         self.db_cur.execute(
@@ -148,7 +633,7 @@ class PixivoDatabase:
             'INSERT INTO FILE (IID,TYPE,REF) VALUES (?,?,?);',
             (illust_id, illust_type, ref_url)
         )
-        self.db_conn.commit()
+        self.__commit()
 
     def insert_manga_file(self, manga_id, base_ref_url, page_count):
         manga_pages = []
@@ -160,38 +645,152 @@ class PixivoDatabase:
             'INSERT INTO FILE (IID,TYPE,REF) VALUES (?,1,?);',
             manga_pages
         )
-        self.db_conn.commit()
+        self.__commit()
 
     def count_file(self, illust_id):
-        self.db_cur.execute(
-            'SELECT COUNT(*) FROM FILE WHERE STATUS=0 AND IID=?;', (illust_id,))
+        # the files of an illust not downloaded yet, claimed ones included
+        self.db_cur.execute(self.count_file_sql, (illust_id,))
         return self.db_cur.fetchone()[0]
 
-    def get_unset_files(self):
-        limit = 10
-        self.db_cur.execute(
-            'SELECT IID, TYPE, REF, URL, PATH FROM FILE WHERE STATUS = 0 LIMIT ?;',
-            (limit,)
-        )
+    def get_unset_files(self, limit=10, after=''):
+        self.db_cur.execute(self.unset_files_sql, (after, limit))
         return self.db_cur.fetchall()
 
     def count_unset_files(self):
-        self.db_cur.execute('SELECT COUNT(*) FROM FILE WHERE STATUS=0;')
+        # unset files and the files of workers whose lease has expired
+        self.db_cur.execute(self.count_unset_files_sql, (int(time.time()),))
         return self.db_cur.fetchone()[0]
 
+    def claim_files(self, owner, limit=10, after='', lease_time=300):
+        # files whose lease has expired, then unset files after the REF,
+        # marked as in progress for the owner in one write transaction, so
+        # two workers never get the same file
+        now = int(time.time())
+        self.flush()
+        self.db_cur.execute('BEGIN IMMEDIATE;')
+        try:
+            self.db_cur.execute(self.expired_files_sql, (now, owner, limit))
+            files = self.db_cur.fetchall()
+            if len(files) < limit:
+                self.db_cur.execute(
+                    self.unset_files_sql, (after, limit - len(files)))
+                unset_files = self.db_cur.fetchall()
+                if unset_files:
+                    after = unset_files[-1][2]
+                files += unset_files
+            self.db_cur.executemany(
+                'UPDATE FILE SET STATUS = 3, OWNER = ?, LEASE = ? WHERE REF = ?;',
+                [(owner, now + lease_time, f[2]) for f in files]
+            )
+            self.__commit_now()
+        except sqlite3.Error:
+            self.db_conn.rollback()
+            raise
+        return files, after
+
+    def release_file(self, ref, owner):
+        # a failed file is unset again, unless another worker took it over
+        self.db_cur.execute(
+            'UPDATE FILE SET STATUS = 0, OWNER = NULL, LEASE = NULL WHERE REF = ? AND STATUS = 3 AND OWNER = ?;',
+            (ref, owner)
+        )
+        self.__commit()
+
+    def register_worker(self, worker_id, host, pid):
+        now = int(time.time())
+        self.db_cur.execute(
+            'INSERT OR REPLACE INTO WORKER (ID,HOST,PID,STARTED,HEARTBEAT,FILES,BYTES) VALUES (?,?,?,?,?,0,0);',
+            (worker_id, host, pid, now, now)
+        )
+        self.__commit_now()
+
+    def heartbeat(self, worker_id, lease_time, files, bytes_count):
+        # renew the leases of the claimed files and record the throughput
+        now = int(time.time())
+        self.db_cur.execute(self.renew_leases_sql, (now + lease_time, worker_id))
+        self.db_cur.execute(
+            'UPDATE WORKER SET HEARTBEAT = ?, FILES = ?, BYTES = ? WHERE ID = ?;',
+            (now, files, bytes_count, worker_id)
+        )
+        self.__commit_now()
+
+    def stop_worker(self, worker_id, files, bytes_count):
+        # the files still claimed are handed back at once
+        now = int(time.time())
+        self.db_cur.execute(
+            'UPDATE FILE SET STATUS = 0, OWNER = NULL, LEASE = NULL WHERE OWNER = ? AND STATUS = 3;',
+            (worker_id,)
+        )
+        self.db_cur.execute(
+            'UPDATE WORKER SET HEARTBEAT = ?, STOPPED = ?, FILES = ?, BYTES = ? WHERE ID = ?;',
+            (now, now, files, bytes_count, worker_id)
+        )
+        self.__commit_now()
+
+    def get_workers(self, limit=20):
+        self.db_cur.execute(
+            '''SELECT ID,HOST,PID,STARTED,HEARTBEAT,STOPPED,FILES,BYTES,
+            (SELECT COUNT(*) FROM FILE WHERE OWNER = WORKER.ID AND STATUS = 3)
+            FROM WORKER ORDER BY STARTED DESC LIMIT ?;''',
+            (limit,))
+        return self.db_cur.fetchall()
+
     def set_file(self, ref, url, path):
         self.db_cur.execute(
             'UPDATE FILE SET URL = ?, PATH = ? WHERE REF = ?;',
             (url, path, ref)
         )
-        self.db_conn.commit()
+        self.__commit()
 
     def set_file_status(self, ref, status=0):
         self.db_cur.execute(
             'UPDATE FILE SET STATUS = ? WHERE REF = ?;',
             (status, ref)
         )
-        self.db_conn.commit()
+        self.__commit()
+
+    def set_files(self, files):
+        # (url, path, ref) rows, finished files are left as they are
+        self.db_cur.executemany(
+            'UPDATE FILE SET URL = ?, PATH = ? WHERE REF = ? AND STATUS IN (0, 3);',
+            files
+        )
+        self.__commit()
+
+    def finish_file(self, ref, url, path, file_hash):
+        self.db_cur.execute(
+            'UPDATE FILE SET URL = ?, PATH = ?, HASH = ?, STATUS = 1, ERROR = NULL, LEASE = NULL WHERE REF = ?;',
+            (url, path, file_hash, ref)
+        )
+        self.__commit()
+
+    def set_file_error(self, ref, error):
+        self.db_cur.execute(
+            'UPDATE FILE SET ERROR = ? WHERE REF = ?;',
+            (error, ref)
+        )
+        self.__commit()
+
+    def get_blob(self, file_hash):
+        self.db_cur.execute(
+            'SELECT PATH FROM BLOB WHERE HASH=?;', (file_hash,))
+        res = self.db_cur.fetchone()
+        return res[0] if res else None
+
+    def get_file_hash(self, ref):
+        # the hash of a finished file and the size recorded for it
+        self.db_cur.execute(
+            'SELECT FILE.HASH, BLOB.SIZE FROM FILE LEFT JOIN BLOB ON BLOB.HASH = FILE.HASH WHERE FILE.REF=?;',
+            (ref,))
+        res = self.db_cur.fetchone()
+        return tuple(res) if res else (None, None)
+
+    def set_blob(self, file_hash, path, size):
+        self.db_cur.execute(
+            'INSERT OR REPLACE INTO BLOB (HASH,PATH,SIZE) VALUES (?,?,?);',
+            (file_hash, path, size)
+        )
+        self.__commit()
 
     def get_illust_status(self, illust_id):
         self.db_cur.execute(
@@ -209,19 +808,26 @@ class PixivoDatabase:
         return res
 
     def get_files_for_illust(self, illust_id):
-        self.db_cur.execute(
-            'SELECT PATH FROM FILE WHERE IID=? AND STATUS = 1;', (illust_id,))
+        self.db_cur.execute(self.files_for_illust_sql, (illust_id,))
         res = self.db_cur.fetchall()
         return res
 
-    def get_illust_info_by_user_id(self, user_id, page=1):
-        limit = 10
-        skip = (page - 1) * limit
-        self.db_cur.execute(
-            'SELECT ID,TITLE,DATE,PAGE,TAGS,RATING,VIEW FROM ILLUST WHERE USER=? ORDER BY RATING DESC LIMIT ?,?;',
-            (user_id, skip, limit))
+    @staticmethod
+    def __next_cursor(rows, limit, *keys):
+        # the sort key of the last row; None once the last page is reached
+        if len(rows) < limit:
+            return None
+        return tuple(rows[-1][key] for key in keys)
+
+    def get_illust_info_by_user_id(self, user_id, cursor=None, limit=10):
+        if cursor:
+            self.db_cur.execute(
+                self.illusts_by_user_after_sql,
+                (user_id,) + tuple(cursor) + (limit,))
+        else:
+            self.db_cur.execute(self.illusts_by_user_sql, (user_id, limit))
         res = self.db_cur.fetchall()
-        return res
+        return res, self.__next_cursor(res, limit, 5, 0)
 
     def get_user_name(self, user_id):
         self.db_cur.execute(
@@ -231,27 +837,90 @@ class PixivoDatabase:
         res = self.db_cur.fetchone()
         return res[0] if res and res[0] else str(user_id)
 
-    def get_user_by_name(self, user_name, page=1):
-        limit = 10
-        skip = (page - 1) * limit
+    @staticmethod
+    def __fts_phrase(text):
+        return '"{}"'.format(text.replace('"', '""'))
+
+    @staticmethod
+    def __prefix_range(text):
+        return text, text + '\U0010ffff'
+
+    @staticmethod
+    def __use_fts(text):
+        # a trigram index can't match less than three characters
+        return fts_trigram and len(text) >= 3
+
+    def get_user_by_name(self, user_name, cursor=None, limit=10):
+        # user names containing the text, or starting with a short one
+        if not user_name.strip():
+            return [], None
+        after = cursor[0] if cursor else -1
+        if self.__use_fts(user_name):
+            matches = 'SELECT ROWID FROM USER_FTS WHERE USER_FTS MATCH ?'
+            params = (self.__fts_phrase(user_name),)
+        elif fts_trigram:
+            matches = 'SELECT ID FROM USER WHERE NAME >= ? AND NAME < ?'
+            params = self.__prefix_range(user_name)
+        else:
+            matches = 'SELECT ROWID FROM USER_FTS WHERE USER_FTS MATCH ?'
+            params = (self.__fts_phrase(user_name) + '*',)
         self.db_cur.execute(
-            'SELECT ID,NAME FROM USER WHERE NAME LIKE ? LIMIT ?,?;',
-            ('%' + user_name + '%', skip, limit)
+            '''SELECT ID,NAME FROM USER
+            WHERE ID IN ({})
+            AND ID > ?
+            ORDER BY ID
+            LIMIT ?;'''.format(matches),
+            params + (after, limit)
         )
-        return self.db_cur.fetchall()
-
-    def get_illust_info_by_keyword(self, keyword, page=1):
-        limit = 10
-        skip = (page - 1) * limit
+        res = self.db_cur.fetchall()
+        return res, self.__next_cursor(res, limit, 0)
+
+    def get_illust_info_by_keyword(self, keyword, cursor=None, limit=10,
+                                   exact=False):
+        # illusts with a tag equal to the keyword when exact, otherwise with
+        # the keyword in their title or in one of their tags; a keyword too
+        # short for the trigram index matches the start of a tag only
+        if not keyword.strip():
+            return [], None
+        if exact:
+            matches = 'SELECT IID FROM ILLUST_TAG WHERE TAG = ?'
+            params = (keyword,)
+        elif self.__use_fts(keyword):
+            matches = """SELECT ROWID FROM ILLUST_FTS WHERE ILLUST_FTS MATCH ?
+            UNION
+            SELECT IID FROM ILLUST_TAG WHERE TAG IN (
+                SELECT NAME FROM TAG WHERE ID IN (
+                    SELECT ROWID FROM TAG_FTS WHERE TAG_FTS MATCH ?))"""
+            params = (self.__fts_phrase(keyword),) * 2
+        elif fts_trigram:
+            matches = 'SELECT IID FROM ILLUST_TAG WHERE TAG >= ? AND TAG < ?'
+            params = self.__prefix_range(keyword)
+        else:
+            matches = """SELECT IID FROM ILLUST_TAG WHERE TAG >= ? AND TAG < ?
+            UNION
+            SELECT ROWID FROM ILLUST_FTS WHERE ILLUST_FTS MATCH ?"""
+            params = self.__prefix_range(keyword) + \
+                (self.__fts_phrase(keyword) + '*',)
+        after = ''
+        if cursor:
+            after = 'AND (RATING, ILLUST.ID) < (?, ?)'
+            params += tuple(cursor)
         self.db_cur.execute(
             '''SELECT ILLUST.ID,TITLE,DATE,USER.NAME,USER.ID,PAGE,TAGS,RATING,VIEW FROM ILLUST
             INNER JOIN USER ON USER.ID = ILLUST.USER
-            WHERE TITLE LIKE ? OR TAGS LIKE ?
-            ORDER BY RATING DESC
-            LIMIT ?,?;''',
-            ('%' + keyword + '%', '%' + keyword + '%', skip, limit))
+            WHERE ILLUST.ID IN ({}) {}
+            ORDER BY RATING DESC, ILLUST.ID DESC
+            LIMIT ?;'''.format(matches, after),
+            params + (limit,))
         res = self.db_cur.fetchall()
-        return res
+        return res, self.__next_cursor(res, limit, 7, 0)
+
+    def close(self):
+        if self.db_conn is not None:
+            self.db_conn.commit()
+            self.db_conn.close()
+            self.db_conn = None
 
     def __del__(self):
-        self.db_conn.close()
+        if hasattr(self, 'db_conn'):
+            self.close()
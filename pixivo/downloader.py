@@ -1,268 +1,650 @@
 import asyncio
+import hashlib
 import json
 import os
 import re
-import shutil
+import socket
 import sys
 import time
-from zipfile import ZipFile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-import aiohttp
-import imageio
-import lxml
-import yaml
-from bs4 import BeautifulSoup
-
-from .database import PixivoDatabase
+from . import metrics
+from .exceptions import PixivoDownloaderException, PixivoNotFoundException
+from .extractor import (manga_image_url, original_image_url,
+                        original_url_prefix, source_url_candidates,
+                        ugoira_info)
+from .fileio import hash_file, preallocate, write_hashed
 from .httpclient import HttpClient
 from .pixiv_auth import PixivoAuth
+from .ugoira import convert_ugoira, ugoira_names
 
 
 class PixivoDownloader(HttpClient):
-    ugoira_info_pattern = re.compile(
-        r'pixiv.context.ugokuIllustFullscreenData  = ({\S+});')
 
-    def __init__(self):
-        super().__init__()
-        self.auth = PixivoAuth()
-        self.data_base = PixivoDatabase()
+    def __init__(self, context=None):
+        super().__init__(context)
+        self.auth = PixivoAuth(self.context)
+        self.data_base = self.context.async_data_base
+
+        config = self.context.config
+        self.concurrency = config.get('concurrency') or 10
+        self.resolve_concurrency = config.get('resolve_concurrency') or 4
+        self.report_interval = config.get('report_interval') or 10
+        # files are claimed for a while, so several downloader processes can
+        # share one database; the claims of a dead process expire after it
+        self.host = socket.gethostname()
+        self.worker_id = config.get('worker_id') or '{}-{}-{:x}'.format(
+            self.host, os.getpid(), int(time.time()))
+        self.lease_time = config.get('lease_time') or 300
+        self.convert_workers = config.get(
+            'convert_workers') or os.cpu_count() or 1
+        self.convert_queue_size = config.get(
+            'convert_queue') or self.convert_workers * 2
+        self.write_buffer = (config.get('write_buffer') or 1024) * 1024
+        self.preallocate = config.get('preallocate', True) != False
+        io_workers = config.get('io_workers') or 4
+        self.ugoira_format = config.get('ugoira_format') or 'gif'
+        if self.ugoira_format not in ugoira_names:
+            raise PixivoDownloaderException(
+                'Unknown ugoira format "%s"!' % self.ugoira_format)
+
+        self.dl_handlers = {
+            0: self.downloadIllust,
+            1: self.downloadMangaPage,
+            2: self.downloadUgoira
+        }
+        self.type_names = {0: 'illust', 1: 'manga', 2: 'ugoira'}
+        self.resolvers = {
+            0: self.resolveIllust,
+            1: self.resolveMangaPage,
+            2: self.resolveUgoira
+        }
+        self.dl_files = 0
+        self.dl_bytes = 0
+        self.dedup_files = 0
+        self.dedup_bytes = 0
+
+        self.io_pool = ThreadPoolExecutor(io_workers)
+        self.convert_pool = None
+        self.convert_queue = None
+        self.converted = 0
+        self.convert_time = 0
+
         self.__init_dld()
 
     def __init_dld(self):
         print('Initializing files....')
-        unsets = self.data_base.get_unset_illust()
-        while unsets:
-            for illust_id, illust_type, illust_page in unsets:
-                if self.data_base.exsit_file(illust_id):
-                    continue
-
-                base_ref_url = 'https://www.pixiv.net/member_illust.php?mode=%s&illust_id=%d'
-
-                if illust_type == 0:
-                    if illust_page > 1:
-                        ref_url = base_ref_url % ('manga_big', illust_id)
-                        self.data_base.insert_manga_file(
-                            illust_id, ref_url, illust_page)
-                        print('id: {}\ntype: illust(manga)\ncount: {}\n'.format(
-                            illust_id, illust_page))
-                    else:
-                        ref_url = base_ref_url % ('medium', illust_id)
-                        self.data_base.insert_illust_file(
-                            illust_id, 0, ref_url)
-                        print('id: {}\ntype: illust\ncount: 1\n'.format(illust_id))
-                elif illust_type == 1:
-                    ref_url = base_ref_url % ('manga_big', illust_id)
-                    self.data_base.insert_manga_file(
-                        illust_id, ref_url, illust_page)
-                    print('id: {}\ntype: manga\ncount: {}\n'.format(
-                        illust_id, illust_page))
-                elif illust_type == 2:
-                    ref_url = base_ref_url % ('medium', illust_id)
-                    self.data_base.insert_illust_file(illust_id, 2, ref_url)
-                    print('id: {}\ntype: ugoira\ncount: 1\n'.format(illust_id))
-                self.data_base.set_illust_status(illust_id)
-            unsets = self.data_base.get_unset_illust()
+        illust_total = file_total = derived_total = 0
+        last_id, illust_count, file_count, derivable = \
+            self.data_base.submit('prepare_files').result()
+        while last_id is not None:
+            # source urls known from the ranking need no page request
+            resolved = self.__derive_files(derivable)
+            self.data_base.post('set_files', resolved)
+            illust_total += illust_count
+            file_total += file_count
+            derived_total += len(resolved)
+            sys.stdout.write('-- {} illusts, {} files, {} source urls\n'.format(
+                illust_total, file_total, derived_total))
+            sys.stdout.flush()
+            last_id, illust_count, file_count, derivable = \
+                self.data_base.submit('prepare_files', last_id).result()
         print('Files initialized successfully!')
 
-    async def downloadIllust(self, illust_id, origin_url, src_url, dl_path):
-        if not src_url:
+    def __derive_files(self, files):
+        # the pages of an illust are adjacent, so each master url is only
+        # parsed once
+        resolved = []
+        last_id = prefix = file_dir = None
+        for illust_id, file_type, ref_url, master_url in files:
+            if illust_id != last_id:
+                last_id = illust_id
+                prefix = original_url_prefix(master_url)
+                file_dir = os.path.join(
+                    self.path, 'manga' if file_type == 1 else 'illust',
+                    str(illust_id), 'p')
+            if not prefix:
+                continue
+            page = ref_url.rsplit('=', 1)[1] if file_type == 1 else '0'
+            resolved.append((prefix + page + '.jpg',
+                             file_dir + page + '.jpg',
+                             ref_url))
+        return resolved
+
+    @staticmethod
+    def __content_range(resp):
+        # (start, total) from a "bytes start-end/total" header
+        match = re.match(r'bytes (\d+|\*)-?\d*/(\d+|\*)',
+                         resp.headers.get('Content-Range', ''))
+        if not match:
+            return None, None
+        start, total = match.groups()
+        return (int(start) if start != '*' else None,
+                int(total) if total != '*' else None)
+
+    async def __write_stream(self, resp, fp, hasher):
+        # chunks are collected into large buffers, hashed and written by the
+        # io pool, the next buffer is read from the network meanwhile
+        loop = asyncio.get_event_loop()
+        buf = bytearray()
+        pending = None
+        try:
+            while True:
+                chunk = await resp.content.readany()
+                if not chunk:
+                    break
+                buf += chunk
+                self.dl_bytes += len(chunk)
+                metrics.downloaded_bytes.inc(amount=len(chunk))
+                if len(buf) >= self.write_buffer:
+                    if pending:
+                        await pending
+                    pending = loop.run_in_executor(
+                        self.io_pool, write_hashed, fp, hasher, bytes(buf))
+                    del buf[:]
+        finally:
+            # also keep what was received before an error, for resuming
+            if pending:
+                await pending
+            if buf:
+                await loop.run_in_executor(
+                    self.io_pool, write_hashed, fp, hasher, bytes(buf))
+
+    async def __fetch(self, src_url, origin_url, dl_path):
+        # returns the sha256 of the file, which is hashed while streaming
+        loop = asyncio.get_event_loop()
+        hasher = hashlib.sha256()
+        part_path = dl_path + '.part'
+        if os.path.isfile(dl_path):
+            file_hash, size = await self.data_base.get_file_hash(origin_url)
+            if file_hash and size in (None, os.path.getsize(dl_path)):
+                return file_hash
+            # older versions wrote to dl_path directly and may have left it
+            # truncated, so it is checked against the server like a part file
+            os.replace(dl_path, part_path)
+        os.makedirs(os.path.dirname(dl_path), exist_ok=True)
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        headers = {'Referer': origin_url}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        async with self.request(src_url, headers=headers) as resp:
+            if resp.status == 416 and offset:
+                _, total = self.__content_range(resp)
+                if total != offset:
+                    os.remove(part_path)
+                    raise PixivoDownloaderException(
+                        'Part file of {} bytes is not resumable'.format(offset))
+                await loop.run_in_executor(
+                    self.io_pool, hash_file, hasher, part_path)
+            elif resp.status in (200, 206):
+                if resp.status == 206:
+                    start, _ = self.__content_range(resp)
+                    if start != offset:
+                        raise PixivoDownloaderException(
+                            'Range starts at {} instead of {}'.format(start, offset))
+                    await loop.run_in_executor(
+                        self.io_pool, hash_file, hasher, part_path)
+                else:
+                    offset = 0
+                total = None
+                if resp.content_length is not None:
+                    total = offset + resp.content_length
+                with open(part_path, 'ab' if offset else 'wb') as fp:
+                    if self.preallocate and total is not None:
+                        preallocate(fp, offset, total - offset)
+                    await self.__write_stream(resp, fp, hasher)
+                size = os.path.getsize(part_path)
+                if total is not None and size != total:
+                    raise PixivoDownloaderException(
+                        'Got {} of {} bytes'.format(size, total))
+            elif resp.status == 404:
+                raise PixivoNotFoundException(
+                    '{} is not found!'.format(src_url))
+            else:
+                raise PixivoDownloaderException(
+                    'HTTP {}'.format(resp.status))
+        os.replace(part_path, dl_path)
+        return hasher.hexdigest()
+
+    async def __fetch_resuming(self, src_url, origin_url, dl_path):
+        # a transfer broken after some progress goes on from its part file,
+        # failures before any data were already retried by the request
+        part_path = dl_path + '.part'
+        while True:
+            offset = os.path.getsize(part_path) \
+                if os.path.isfile(part_path) else 0
             try:
-                resp = await self.request(origin_url)
-                html = await resp.text()
-                soup = BeautifulSoup(html, 'lxml')
-                src_url = soup.select_one(
-                    'img.original-image').attrs['data-src']
-                ext_name = os.path.splitext(src_url)[1]
-                file_name = 'p0%s' % ext_name
-                file_path = os.path.join(self.path, 'illust', str(illust_id))
-                os.makedirs(file_path, exist_ok=True)
-                dl_path = os.path.join(file_path, file_name)
-                self.data_base.set_file(origin_url, src_url, dl_path)
-            except Exception as err:
-                sys.stdout.write(
-                    'resolve {} -x> Boom!\n'.format(illust_id))
-                print(err)
-                sys.stdout.flush()
-                return
-        resp = None
-        base_name = os.path.basename(src_url)
+                return await self.__fetch(src_url, origin_url, dl_path)
+            except self.retry_errors:
+                if not os.path.isfile(part_path) or \
+                        os.path.getsize(part_path) <= offset:
+                    raise
+
+    async def __link_blob(self, file_hash, dl_path):
+        # replace dl_path with a hard link to a known file of the same content
+        blob_path = await self.data_base.get_blob(file_hash)
+        if not blob_path or blob_path == dl_path or \
+                not os.path.isfile(blob_path):
+            return False
+        if os.path.splitext(blob_path)[1] != os.path.splitext(dl_path)[1]:
+            return False
+        link_path = dl_path + '.link'
         try:
-            resp = await self.request(src_url, headers={'Referer': origin_url})
-            with open(dl_path, 'wb') as fp:
-                while True:
-                    chunk = await resp.content.readany()
-                    if not chunk:
-                        break
-                    fp.write(chunk)
-                sys.stdout.write(
-                    '{} --> OK!\n{} Saved!\n'.format(base_name, dl_path))
-                sys.stdout.flush()
-                self.data_base.set_file_status(origin_url, 1)
-                self.data_base.set_illust_status(illust_id, 2)
-        except Exception:
-            if os.path.isfile(dl_path):
-                os.remove(dl_path)
+            if os.path.isfile(link_path):
+                os.remove(link_path)
+            os.link(blob_path, link_path)
+            os.replace(link_path, dl_path)
+        except OSError:
+            return False
+        self.dedup_files += 1
+        self.dedup_bytes += os.path.getsize(dl_path)
+        return True
+
+    async def __finish_file(self, origin_url, src_url, dl_path, file_hash):
+        if not await self.__link_blob(file_hash, dl_path):
+            self.data_base.post(
+                'set_blob', file_hash, dl_path, os.path.getsize(dl_path))
+        self.data_base.post(
+            'finish_file', origin_url, src_url, dl_path, file_hash)
+
+    def __illust_path(self, illust_id, src_url):
+        ext_name = os.path.splitext(src_url)[1]
+        return os.path.join(
+            self.path, 'illust', str(illust_id), 'p0%s' % ext_name)
+
+    def __manga_path(self, illust_id, src_url):
+        iid = str(illust_id)
+        file_name = os.path.basename(src_url).replace(iid + '_', '')
+        return os.path.join(self.path, 'manga', iid, file_name)
+
+    async def resolveIllust(self, illust_id, origin_url):
+        try:
+            async with self.request(origin_url) as resp:
+                if resp.status != 200:
+                    raise PixivoDownloaderException(
+                        'HTTP {}'.format(resp.status))
+                html = await resp.text()
+            src_url = original_image_url(html)
+            if not src_url:
+                raise PixivoDownloaderException(
+                    'Can\'t find the original image on this page!')
+        except Exception as err:
             sys.stdout.write(
-                '{} -x> Error!\n'.format(base_name))
+                'resolve {} -x> Boom!\n'.format(illust_id))
+            print(err)
             sys.stdout.flush()
-        finally:
-            if resp:
-                resp.close()
+            self.__record_error(origin_url, err)
+            return None
+        return src_url, self.__illust_path(illust_id, src_url)
 
-    async def downloadMangaPage(self, illust_id, origin_url, src_url, dl_path):
+    async def resolveMangaPage(self, illust_id, origin_url):
+        try:
+            async with self.request(origin_url) as resp:
+                if resp.status != 200:
+                    raise PixivoDownloaderException(
+                        'HTTP {}'.format(resp.status))
+                html = await resp.text()
+            src_url = manga_image_url(html)
+        except Exception as err:
+            sys.stdout.write(
+                'resolve {} -x> Boom!\n'.format(illust_id))
+            print(err)
+            sys.stdout.flush()
+            self.__record_error(origin_url, err)
+            return None
         if not src_url:
-            try:
-                resp = await self.request(origin_url)
+            self.data_base.post('set_file_status', origin_url, 2)
+            self.data_base.post(
+                'set_file_error', origin_url,
+                'Can\'t find the image on this page!')
+            sys.stdout.write(
+                'resolve {} -x> Wrong!\n'.format(illust_id))
+            sys.stdout.flush()
+            return None
+        return src_url, self.__manga_path(illust_id, src_url)
+
+    async def resolveUgoira(self, illust_id, origin_url):
+        file_path = os.path.join(self.path, 'ugoira', str(illust_id))
+        try:
+            async with self.request(origin_url) as resp:
+                if resp.status != 200:
+                    raise PixivoDownloaderException(
+                        'HTTP {}'.format(resp.status))
                 html = await resp.text()
-                soup = BeautifulSoup(html, 'lxml')
-                img = soup.select_one(
-                    'body > img')
-                if not img:
-                    self.data_base.set_file_status(origin_url, 2)
-                    sys.stdout.write(
-                        'resolve {} -x> Wrong!\n'.format(illust_id))
-                    sys.stdout.flush()
-                    return
-                src_url = img.attrs['src']
-                base_name = os.path.basename(src_url)
-                iid = str(illust_id)
-                file_name = base_name.replace(iid + '_', '')
-                file_path = os.path.join(self.path, 'manga', iid)
-                os.makedirs(file_path, exist_ok=True)
-                dl_path = os.path.join(file_path, file_name)
-                self.data_base.set_file(origin_url, src_url, dl_path)
-            except Exception as err:
-                sys.stdout.write(
-                    'resolve {} -x> Boom!\n'.format(illust_id))
-                print(err)
-                sys.stdout.flush()
-                return
-        resp = None
+            info = ugoira_info(html)
+            if not info:
+                raise PixivoDownloaderException(
+                    'Can\'t find the ugoira data on this page!')
+            src_url = info['src']
+            os.makedirs(file_path, exist_ok=True)
+            fr_path = os.path.join(file_path, 'frames.json')
+            with open(fr_path, 'w', encoding='utf-8') as fp:
+                json.dump(info['frames'], fp,
+                          ensure_ascii=False, sort_keys=True)
+        except Exception as err:
+            sys.stdout.write(
+                'resolve {} -x> Boom!\n'.format(illust_id))
+            print(err)
+            sys.stdout.flush()
+            self.__record_error(origin_url, err)
+            return None
+        return src_url, os.path.join(file_path, os.path.basename(src_url))
+
+    async def __timed_resolve(self, resolve, illust_id, origin_url):
+        st = time.time()
+        resolved = await resolve(illust_id, origin_url)
+        metrics.stage_seconds.observe(time.time() - st, 'resolve')
+        return resolved
+
+    def __record_error(self, origin_url, err):
+        # the last failure of a file, cleared once it is downloaded
+        self.data_base.post(
+            'set_file_error', origin_url,
+            '{}: {}'.format(type(err).__name__, err))
+
+    def __save_resolved(self, origin_url, src_url, dl_path):
+        self.data_base.post('set_files', [(src_url, dl_path, origin_url)])
+
+    async def __fetch_source(self, origin_url, src_url, dl_path):
+        # an original url derived from the ranking guesses the extension,
+        # so the other extensions are tried when it is not found
+        for cand_url in source_url_candidates(src_url):
+            cand_path = os.path.splitext(dl_path)[0] + \
+                os.path.splitext(cand_url)[1]
+            try:
+                file_hash = await self.__fetch_resuming(
+                    cand_url, origin_url, cand_path)
+            except PixivoNotFoundException:
+                continue
+            return cand_url, cand_path, file_hash
+        # resolve the page next time
+        self.data_base.post('set_file', origin_url, None, None)
+        raise PixivoNotFoundException('{} is not found!'.format(src_url))
+
+    async def __download(self, resolve, illust_id, origin_url, src_url, dl_path):
+        # returns (src_url, dl_path, file_hash) of a complete file or None
+        if not src_url:
+            resolved = await self.__timed_resolve(
+                resolve, illust_id, origin_url)
+            if not resolved:
+                return None
+            src_url, dl_path = resolved
+            self.__save_resolved(origin_url, src_url, dl_path)
         base_name = os.path.basename(src_url)
+        st = time.time()
         try:
-            resp = await self.request(src_url, headers={'Referer': origin_url})
-            with open(dl_path, 'wb') as fp:
-                while True:
-                    chunk = await resp.content.readany()
-                    if not chunk:
-                        break
-                    fp.write(chunk)
-                sys.stdout.write(
-                    '{} --> OK!\n{} Saved!\n'.format(base_name, dl_path))
-                sys.stdout.flush()
-                self.data_base.set_file_status(origin_url, 1)
-                if not self.data_base.count_file(illust_id):
-                    self.data_base.set_illust_status(illust_id, 2)
-        except Exception:
-            if os.path.isfile(dl_path):
-                os.remove(dl_path)
+            src_url, dl_path, file_hash = await self.__fetch_source(
+                origin_url, src_url, dl_path)
+            metrics.stage_seconds.observe(time.time() - st, 'fetch')
+        except Exception as err:
             sys.stdout.write(
                 '{} -x> Error!\n'.format(base_name))
+            print(err)
             sys.stdout.flush()
-        finally:
-            if resp:
-                resp.close()
+            self.__record_error(origin_url, err)
+            return None
+        sys.stdout.write(
+            '{} --> OK!\n{} Saved!\n'.format(
+                os.path.basename(src_url), dl_path))
+        sys.stdout.flush()
+        return src_url, dl_path, file_hash
+
+    async def downloadIllust(self, illust_id, origin_url, src_url, dl_path):
+        downloaded = await self.__download(
+            self.resolveIllust, illust_id, origin_url, src_url, dl_path)
+        if not downloaded:
+            return
+        await self.__finish_file(origin_url, *downloaded)
+        self.data_base.post('set_illust_status', illust_id, 2)
+        return True
+
+    async def downloadMangaPage(self, illust_id, origin_url, src_url, dl_path):
+        downloaded = await self.__download(
+            self.resolveMangaPage, illust_id, origin_url, src_url, dl_path)
+        if not downloaded:
+            return
+        await self.__finish_file(origin_url, *downloaded)
+        # the finished page is written first, the calls run in order
+        if not await self.data_base.count_file(illust_id):
+            self.data_base.post('set_illust_status', illust_id, 2)
+        return True
 
     async def downloadUgoira(self, illust_id, origin_url, src_url, dl_path):
-        file_path = os.path.join(self.path, 'ugoira', str(illust_id))
-        if not src_url:
-            try:
-                resp = await self.request(origin_url)
-                html = await resp.text()
-                result = re.search(self.ugoira_info_pattern, html).group(1)
-                ugoira_info = json.loads(result)
-                src_url = ugoira_info['src']
-                file_name = os.path.basename(src_url)
-                frames_info = ugoira_info['frames']
-                os.makedirs(file_path, exist_ok=True)
-                dl_path = os.path.join(file_path, file_name)
-                fr_path = os.path.join(file_path, 'frames.json')
-                with open(fr_path, 'w', encoding='utf-8') as fp:
-                    json.dump(frames_info, fp,
-                              ensure_ascii=False, sort_keys=True)
-                self.data_base.set_file(origin_url, src_url, dl_path)
-            except Exception as err:
-                sys.stdout.write(
-                    'resolve {} -x> Boom!\n'.format(illust_id))
-                print(err)
-                sys.stdout.flush()
-                return
+        downloaded = await self.__download(
+            self.resolveUgoira, illust_id, origin_url, src_url, dl_path)
+        if not downloaded:
+            return
+        src_url, dl_path, file_hash = downloaded
+        file_path = os.path.dirname(dl_path)
         fr_path = os.path.join(file_path, 'frames.json')
-        extract_path = os.path.join(file_path, 'tmp')
-
         frames_info = []
         with open(fr_path, 'r', encoding='utf-8') as fp:
             frames_info = json.load(fp)
-        resp = None
-        base_name = os.path.basename(src_url)
+        out_name = os.path.join(file_path, ugoira_names[self.ugoira_format])
+        # the same zip was converted before, link its output instead
+        if await self.__link_blob(file_hash, out_name):
+            os.remove(dl_path)
+            self.data_base.post(
+                'finish_file', origin_url, src_url, out_name, file_hash)
+            self.data_base.post('set_illust_status', illust_id, 2)
+            return True
+        conversion = (illust_id, origin_url, src_url, dl_path,
+                      frames_info, out_name, file_hash, time.time())
+        if self.convert_queue:
+            await self.convert_queue.put(conversion)
+        else:
+            await self.__convert(*conversion)
+        # neither done nor failed yet, __convert counts the result
+        return False
+
+    async def __convert(self, illust_id, origin_url, src_url, dl_path,
+                        frames_info, out_name, file_hash, queued):
+        loop = asyncio.get_event_loop()
+        base_name = os.path.basename(out_name)
         try:
-            resp = await self.request(src_url, headers={'Referer': origin_url})
-            with open(dl_path, 'wb') as fp:
-                while True:
-                    chunk = await resp.content.readany()
-                    if not chunk:
-                        break
-                    fp.write(chunk)
-                sys.stdout.write(
-                    '{} --> OK!\n{} Saved!\n'.format(base_name, dl_path))
-                sys.stdout.flush()
-            os.makedirs(extract_path, exist_ok=True)
-            with ZipFile(dl_path) as zf:
-                zf.extractall(extract_path)
-            frames = []
-            delays = []
-            gif_name = os.path.join(file_path, 'p0.gif')
-            for frame in frames_info:
-                frames.append(imageio.imread(
-                    os.path.join(extract_path, frame['file'])))
-                delays.append(frame['delay'] / 1000)
-            imageio.mimsave(gif_name, frames, 'GIF', duration=delays)
-            shutil.rmtree(extract_path)
-            if os.path.isfile(dl_path):
-                os.remove(dl_path)
-            self.data_base.set_file(origin_url, src_url, gif_name)
-            self.data_base.set_file_status(origin_url, 1)
-            self.data_base.set_illust_status(illust_id, 2)
-        except Exception:
-            shutil.rmtree(extract_path)
+            elapsed = await loop.run_in_executor(
+                self.convert_pool, convert_ugoira,
+                dl_path, frames_info, out_name, self.ugoira_format)
+        except Exception as err:
             if os.path.isfile(dl_path):
                 os.remove(dl_path)
             sys.stdout.write(
-                '{} -x> Error!\n'.format(base_name))
+                '{} {} -x> Convert error!\n'.format(illust_id, base_name))
+            print(err)
             sys.stdout.flush()
-        finally:
-            if resp:
-                resp.close()
+            metrics.files.inc('ugoira', 'error')
+            # the file stays claimed until the worker stops, so it is not
+            # downloaded and converted again in this run
+            self.__record_error(origin_url, err)
+            return
+        self.converted += 1
+        self.dl_files += 1
+        metrics.files.inc('ugoira', 'ok')
+        self.convert_time += elapsed
+        metrics.stage_seconds.observe(elapsed, 'convert')
+        metrics.stage_seconds.observe(
+            time.time() - queued - elapsed, 'convert_wait')
+        sys.stdout.write(
+            '{} {} --> Converted in {:.2f} s (queued {:.2f} s)!\n'.format(
+                illust_id, base_name, elapsed,
+                time.time() - queued - elapsed))
+        sys.stdout.flush()
+        self.data_base.post(
+            'set_blob', file_hash, out_name, os.path.getsize(out_name))
+        self.data_base.post(
+            'finish_file', origin_url, src_url, out_name, file_hash)
+        self.data_base.post('set_illust_status', illust_id, 2)
+
+    async def __convert_worker(self):
+        while True:
+            conversion = await self.convert_queue.get()
+            try:
+                if conversion is None:
+                    break
+                await self.__convert(*conversion)
+            finally:
+                self.convert_queue.task_done()
+
+    def __release_file(self, origin_url):
+        self.data_base.post('release_file', origin_url, self.worker_id)
+
+    async def __feed(self, resolve_queue, fetch_queue):
+        # files with a known source url skip the page request; failed files
+        # are released behind the REF, so they wait for the next pass
+        unset_files, last_ref = await self.data_base.claim_files(
+            self.worker_id, self.concurrency, '', self.lease_time)
+        while unset_files:
+            for unset_file in unset_files:
+                if unset_file[3]:
+                    await fetch_queue.put(unset_file)
+                else:
+                    await resolve_queue.put(unset_file)
+            unset_files, last_ref = await self.data_base.claim_files(
+                self.worker_id, self.concurrency, last_ref, self.lease_time)
+        for _ in range(self.resolve_concurrency):
+            await resolve_queue.put(None)
+
+    async def __resolve(self, resolve_queue, fetch_queue):
+        while True:
+            unset_file = await resolve_queue.get()
+            if unset_file is None:
+                break
+            illust_id, dl_type, origin_url, _, _ = unset_file
+            resolve = self.resolvers.get(dl_type)
+            if not resolve:
+                self.__release_file(origin_url)
+                continue
+            resolved = await self.__timed_resolve(
+                resolve, illust_id, origin_url)
+            if not resolved:
+                self.__release_file(origin_url)
+                continue
+            src_url, dl_path = resolved
+            self.__save_resolved(origin_url, src_url, dl_path)
+            await fetch_queue.put(
+                (illust_id, dl_type, origin_url, src_url, dl_path))
+
+    async def __work(self, queue):
+        while True:
+            unset_file = await queue.get()
+            if unset_file is None:
+                break
+            illust_id, dl_type, origin_url, src_url, dl_path = unset_file
+            download = self.dl_handlers.get(dl_type)
+            if not download:
+                self.__release_file(origin_url)
+                continue
+            type_name = self.type_names.get(dl_type)
+            try:
+                downloaded = await download(
+                    illust_id, origin_url, src_url, dl_path)
+                if downloaded:
+                    self.dl_files += 1
+                    metrics.files.inc(type_name, 'ok')
+                elif downloaded is None:
+                    metrics.files.inc(type_name, 'error')
+                    self.__release_file(origin_url)
+            except Exception as err:
+                metrics.files.inc(type_name, 'error')
+                sys.stdout.write(
+                    '{} -x> Error!\n'.format(origin_url))
+                print(err)
+                sys.stdout.flush()
+                self.__record_error(origin_url, err)
+                self.__release_file(origin_url)
+
+    def __print_rate(self, st):
+        elapsed = max(time.time() - st, 1e-6)
+        sys.stdout.write('-- {} files, {:.2f} files/s, {:.2f} MiB/s\n'.format(
+            self.dl_files,
+            self.dl_files / elapsed,
+            self.dl_bytes / elapsed / 1048576))
+        sys.stdout.flush()
+
+    async def __report(self, st):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.__print_rate(st)
+
+    async def __heartbeat(self):
+        # renew the leases well before they expire
+        while True:
+            await asyncio.sleep(max(self.lease_time / 3, 1))
+            await self.data_base.heartbeat(
+                self.worker_id, self.lease_time, self.dl_files, self.dl_bytes)
 
     async def start(self):
         await self.auth.checkLogin()
         st = time.time()
-        unset_files = self.data_base.get_unset_files()
-        p_count = 1
-        while unset_files:
-            tot = self.data_base.count_unset_files()
-            sys.stdout.write('T{}. Start downloading {} files, total {} files rest...\n'.format(
-                p_count, len(unset_files), tot))
-            sys.stdout.flush()
-            dl_tasks = []
-            for illust_id, dl_type, origin_url, src_url, dl_path in unset_files:
-                if dl_type == 0:
-                    dl_tasks.append(asyncio.ensure_future(
-                        self.downloadIllust(
-                            illust_id, origin_url, src_url, dl_path)
-                    ))
-                elif dl_type == 1:
-                    dl_tasks.append(asyncio.ensure_future(
-                        self.downloadMangaPage(
-                            illust_id, origin_url, src_url, dl_path)
-                    ))
-                elif dl_type == 2:
-                    dl_tasks.append(asyncio.ensure_future(
-                        self.downloadUgoira(
-                            illust_id, origin_url, src_url, dl_path)
-                    ))
-            await asyncio.gather(* dl_tasks)
-            unset_files = self.data_base.get_unset_files()
-            p_count += 1
+        await metrics.exporter(self.context.config).start()
+        await self.data_base.register_worker(
+            self.worker_id, self.host, os.getpid())
+        try:
+            await self.__download_all(st)
+        finally:
+            await self.data_base.stop_worker(
+                self.worker_id, self.dl_files, self.dl_bytes)
+            await metrics.exporter(self.context.config).stop()
         print()
+        print('-- worker {}'.format(self.worker_id))
+        self.__print_rate(st)
+        if self.converted:
+            print('-- {} ugoira converted, {:.2f} s each on average'.format(
+                self.converted, self.convert_time / self.converted))
+        if self.dedup_files:
+            print('-- {} duplicate files linked, {:.2f} MiB saved'.format(
+                self.dedup_files, self.dedup_bytes / 1048576))
+        print('-- {}'.format(self.conn_stats()))
         print('Finished in {} s!'.format(time.time() - st))
+
+    async def __download_all(self, st):
+        reporter = asyncio.ensure_future(self.__report(st))
+        heartbeat = asyncio.ensure_future(self.__heartbeat())
+        self.convert_pool = ProcessPoolExecutor(self.convert_workers)
+        self.convert_queue = asyncio.Queue(maxsize=self.convert_queue_size)
+        converters = [asyncio.ensure_future(self.__convert_worker())
+                      for _ in range(self.convert_workers)]
+        tasks = []
+        metrics.queue_depth.set_function(self.convert_queue.qsize, 'convert')
+        try:
+            p_count = 1
+            tot = await self.data_base.count_unset_files()
+            while tot:
+                sys.stdout.write('T{}. Start downloading {} files with {} workers...\n'.format(
+                    p_count, tot, self.concurrency))
+                sys.stdout.flush()
+                done = self.dl_files
+                resolve_queue = asyncio.Queue(maxsize=self.resolve_concurrency)
+                fetch_queue = asyncio.Queue(maxsize=self.concurrency)
+                metrics.queue_depth.set_function(resolve_queue.qsize, 'resolve')
+                metrics.queue_depth.set_function(fetch_queue.qsize, 'fetch')
+                resolvers = [asyncio.ensure_future(
+                    self.__resolve(resolve_queue, fetch_queue))
+                    for _ in range(self.resolve_concurrency)]
+                workers = [asyncio.ensure_future(self.__work(fetch_queue))
+                           for _ in range(self.concurrency)]
+                tasks = resolvers + workers
+                await self.__feed(resolve_queue, fetch_queue)
+                await asyncio.gather(*resolvers)
+                for _ in workers:
+                    await fetch_queue.put(None)
+                await asyncio.gather(*workers)
+                # ugoira files are only finished after their conversion
+                await self.convert_queue.join()
+                if self.dl_files == done:
+                    # nothing succeeded in this pass, leave the rest for next run
+                    break
+                tot = await self.data_base.count_unset_files()
+                p_count += 1
+            for _ in converters:
+                await self.convert_queue.put(None)
+            await asyncio.gather(*converters)
+        finally:
+            # also when a pass raised, nothing may keep running
+            for task in tasks + converters + [reporter, heartbeat]:
+                task.cancel()
+            self.convert_pool.shutdown()
+            self.convert_pool = None
+            self.convert_queue = None
+            for queue_name in ('resolve', 'fetch', 'convert'):
+                metrics.queue_depth.set(0, queue_name)
@@ -20,3 +20,21 @@ class PixivoDBException(PixivoBaseException):
 
     def __init__(self, message):
         super().__init__(message)
+
+
+class PixivoDownloaderException(PixivoBaseException):
+
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class PixivoNotFoundException(PixivoDownloaderException):
+
+    def __init__(self, message):
+        super().__init__(message)
+
+
+class PixivoExportException(PixivoBaseException):
+
+    def __init__(self, message):
+        super().__init__(message)
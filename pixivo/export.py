@@ -0,0 +1,160 @@
+import errno
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .exceptions import PixivoExportException
+
+# the ways tried in turn to place a file, copy always works
+export_modes = {
+    'auto': ('link', 'reflink', 'copy'),
+    'link': ('link', 'copy'),
+    'reflink': ('reflink', 'copy'),
+    'symlink': ('symlink',),
+    'copy': ('copy',)
+}
+
+# errors telling a way does not work between these paths at all
+_unsupported = (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY,
+                errno.EINVAL, errno.ENOSYS)
+
+
+def _symlink(src_path, dst_path):
+    os.symlink(os.path.abspath(src_path), dst_path)
+
+
+def _reflink(src_path, dst_path):
+    # ctypes is only loaded when a reflink is tried
+    from .fileio import reflink
+
+    reflink(src_path, dst_path)
+
+
+_placers = {
+    'link': os.link,
+    'reflink': _reflink,
+    'symlink': _symlink,
+    'copy': shutil.copy
+}
+
+
+def clear_path(path, workers=8):
+    # remove everything in the path on a thread pool, the unlinks of a large
+    # result path are mostly waiting for the file system
+    def remove(entry):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+    with os.scandir(path) as entries:
+        entries = list(entries)
+    with ThreadPoolExecutor(workers) as pool:
+        list(pool.map(remove, entries))
+    return len(entries)
+
+
+class ResultExporter:
+    # places the files of search results in the result path as hard links,
+    # reflinks, symlinks or copies made on a thread pool, or streams them
+    # into one tar or zip archive there
+
+    def __init__(self, result_path, mode='auto', workers=8, archive=None):
+        if mode not in export_modes:
+            raise PixivoExportException(
+                'Unknown export mode "{}"!'.format(mode))
+        self.result_path = result_path
+        self.ways = export_modes[mode]
+        self.broken = set()
+        self.lock = threading.Lock()
+        self.counts = dict((way, 0) for way in _placers)
+        self.copied_bytes = 0
+        self.errors = 0
+        self.archive = None
+        self.archive_path = None
+        if archive:
+            self.archive_path = os.path.join(result_path, archive)
+            if archive.endswith('.zip'):
+                import zipfile
+
+                # the images are compressed already
+                self.archive = zipfile.ZipFile(
+                    self.archive_path, 'w', zipfile.ZIP_STORED)
+            elif archive.endswith('.tar'):
+                import tarfile
+
+                self.archive = tarfile.open(self.archive_path, 'w')
+            else:
+                raise PixivoExportException(
+                    'The archive "{}" is neither a .zip nor a .tar!'.format(archive))
+            # one writer keeps the archive in order
+            workers = 1
+        self.pool = ThreadPoolExecutor(workers)
+        self.futures = []
+
+    def add(self, src_path, name):
+        # returns at once, the file is placed in the background
+        self.futures.append(self.pool.submit(self.__export, src_path, name))
+
+    def __export(self, src_path, name):
+        try:
+            if self.archive is not None:
+                self.__add_to_archive(src_path, name)
+            else:
+                self.__place(src_path, os.path.join(self.result_path, name))
+        except OSError as err:
+            with self.lock:
+                self.errors += 1
+            print('{} -x> {}'.format(name, err))
+
+    def __add_to_archive(self, src_path, name):
+        if self.archive_path.endswith('.zip'):
+            self.archive.write(src_path, name)
+        else:
+            self.archive.add(src_path, name)
+        self.counts['copy'] += 1
+        self.copied_bytes += os.path.getsize(src_path)
+
+    def __place(self, src_path, dst_path):
+        if os.path.lexists(dst_path):
+            os.remove(dst_path)
+        ways = [way for way in self.ways if way not in self.broken]
+        for way in ways:
+            try:
+                _placers[way](src_path, dst_path)
+            except OSError as err:
+                if way == ways[-1] or err.errno not in _unsupported:
+                    raise
+                # e.g. the result path is on another device, skip this way
+                # for the other files
+                with self.lock:
+                    self.broken.add(way)
+                continue
+            with self.lock:
+                self.counts[way] += 1
+                if way == 'copy':
+                    self.copied_bytes += os.path.getsize(dst_path)
+            return
+
+    def close(self):
+        # waits until every file is placed
+        for future in self.futures:
+            future.result()
+        self.futures = []
+        self.pool.shutdown()
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+    def summary(self):
+        names = {'link': 'linked', 'reflink': 'reflinked',
+                 'symlink': 'symlinked', 'copy': 'copied'}
+        parts = ['{} {}'.format(count, names[way])
+                 for way, count in self.counts.items() if count]
+        if self.copied_bytes:
+            parts.append('{:.2f} MiB copied'.format(self.copied_bytes / 1048576))
+        if self.errors:
+            parts.append('{} failed'.format(self.errors))
+        if self.archive_path:
+            parts.append('into {}'.format(self.archive_path))
+        return ', '.join(parts) or 'no files'
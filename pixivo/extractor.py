@@ -0,0 +1,77 @@
+import html
+import json
+import os
+import re
+
+_attr_pattern = re.compile(
+    r'([^\s"\'<>/=]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'=<>`]+))')
+_body_img_pattern = re.compile(r'<body\b[^>]*>\s*(<img\b[^>]*>)', re.I)
+_ugoira_info_pattern = re.compile(
+    r'pixiv.context.ugokuIllustFullscreenData  = ({\S+});')
+_master_url_pattern = re.compile(
+    r'^(https?://[^/]+)/c/[^/]+/img-master/img/((?:\d+/){6})(\d+)_p0_(?:master|square)1200\.\w+$')
+_original_exts = ('.jpg', '.png', '.gif')
+
+
+def _tag_attrs(tag):
+    attrs = {}
+    for name, dq_value, sq_value, value in _attr_pattern.findall(tag):
+        attrs.setdefault(name.lower(), html.unescape(
+            dq_value or sq_value or value))
+    return attrs
+
+
+def _soup(page):
+    from bs4 import BeautifulSoup
+
+    return BeautifulSoup(page, 'lxml')
+
+
+def original_image_url(page):
+    # <img class="original-image" data-src="..."> on the medium page
+    pos = page.find('original-image')
+    while pos != -1:
+        start = page.rfind('<', 0, pos)
+        end = page.find('>', pos)
+        if start != -1 and end != -1 and \
+                page[start:start + 4].lower() == '<img':
+            attrs = _tag_attrs(page[start:end + 1])
+            if 'original-image' in attrs.get('class', '').split() and \
+                    attrs.get('data-src'):
+                return attrs['data-src']
+        pos = page.find('original-image', pos + 1)
+    img = _soup(page).select_one('img.original-image')
+    return img.attrs.get('data-src') if img else None
+
+
+def manga_image_url(page):
+    # the only <img> right under <body> on the manga_big page
+    match = _body_img_pattern.search(page)
+    if match:
+        src = _tag_attrs(match.group(1)).get('src')
+        if src:
+            return src
+    img = _soup(page).select_one('body > img')
+    return img.attrs.get('src') if img else None
+
+
+def ugoira_info(page):
+    match = _ugoira_info_pattern.search(page)
+    return json.loads(match.group(1)) if match else None
+
+
+def original_url_prefix(master_url):
+    # the ranking thumbnail shares its date path with the original image,
+    # the url of page n is the prefix + 'n.jpg'
+    match = _master_url_pattern.match(master_url or '')
+    if not match:
+        return None
+    return '{}/img-original/img/{}{}_p'.format(*match.groups())
+
+
+def source_url_candidates(src_url):
+    base_url, ext_name = os.path.splitext(src_url)
+    if '/img-original/' not in src_url or ext_name not in _original_exts:
+        return [src_url]
+    return [src_url] + [base_url + ext for ext in _original_exts
+                        if ext != ext_name]
@@ -0,0 +1,59 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import sys
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FALLOC_FL_KEEP_SIZE = 1
+FICLONE = 0x40049409
+
+_libc = None
+if sys.platform.startswith('linux'):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.fallocate.argtypes = [
+            ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    except (OSError, AttributeError):
+        _libc = None
+
+
+def preallocate(fp, offset, length):
+    # reserve the blocks without changing the file size, so the size of a
+    # part file still tells how much of it has been written
+    if _libc is None or length <= 0:
+        return False
+    return _libc.fallocate(
+        fp.fileno(), FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+def hash_file(hasher, path, block_size=1048576):
+    with open(path, 'rb') as fp:
+        while True:
+            block = fp.read(block_size)
+            if not block:
+                break
+            hasher.update(block)
+
+
+def write_hashed(fp, hasher, data):
+    hasher.update(data)
+    fp.write(data)
+
+
+def reflink(src_path, dst_path):
+    # a copy on write clone sharing the blocks of the source, where the file
+    # system supports it (btrfs, xfs, ...); raises OSError otherwise
+    if fcntl is None or not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported', dst_path)
+    with open(src_path, 'rb') as src_fp, open(dst_path, 'wb') as dst_fp:
+        try:
+            fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+        except OSError:
+            dst_fp.close()
+            os.remove(dst_path)
+            raise
@@ -1,23 +1,71 @@
+import asyncio
 import os
+import random
+import time
+from email.utils import parsedate_to_datetime
 
 import aiohttp
-import yaml
+from yarl import URL
 
+from . import metrics
+from .ratelimit import HostLimiter
 
-class HttpClient:
 
-    def __init__(self):
-        with open('_config.yml') as fp:
-            config = yaml.load(fp)
-            self.proxy = config['proxy'] if 'proxy' in config else None
-            self.path = config['path']
+class _RequestContext:
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.resp = None
+        self.limiter = None
+
+    async def __aenter__(self):
+        self.resp, self.limiter = await self.coro
+        return self.resp
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.resp.release()
+        self.limiter.release()
+
+
+class HttpSession:
+    # the connection pool, cookie jar and host limits of a whole run
+
+    retry_errors = (aiohttp.ClientError, asyncio.TimeoutError)
+    retry_statuses = (403, 429, 500, 502, 503, 504)
+    throttle_statuses = (403, 429, 503)
+
+    def __init__(self, config):
+        self.proxy = config['proxy'] if 'proxy' in config else None
+        self.path = config['path']
+        conn_limit = config.get('conn_limit') or 100
+        conn_limit_per_host = config.get('conn_limit_per_host') or 10
+        keepalive_timeout = config.get('keepalive_timeout') or 30
+        self.host_rate = config.get('host_rate') or 10
+        self.retries = config.get('retries')
+        if self.retries is None:
+            self.retries = 3
+        self.backoff_base = config.get('backoff_base') or 1
+        self.backoff_max = config.get('backoff_max') or 60
+
+        self.conn_limit_per_host = conn_limit_per_host
+        self.limiters = {}
+        self.retried = 0
+        self.throttled = 0
 
         conn = aiohttp.TCPConnector(
             verify_ssl=False,
             use_dns_cache=True,
-            force_close=True
+            limit=conn_limit,
+            limit_per_host=conn_limit_per_host,
+            keepalive_timeout=keepalive_timeout
         )
 
+        self.new_conns = 0
+        self.reused_conns = 0
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_end.append(self.__on_conn_create)
+        trace_config.on_connection_reuseconn.append(self.__on_conn_reuse)
+
         self.cookie_path = os.path.join(self.path, 'cookie')
         jar = aiohttp.CookieJar()
         if os.path.isfile(self.cookie_path):
@@ -27,24 +75,141 @@ class HttpClient:
                 pass
 
         self.session = aiohttp.ClientSession(
-            connector=conn, cookie_jar=jar)
+            connector=conn, cookie_jar=jar, trace_configs=[trace_config])
+
+    async def __on_conn_create(self, session, ctx, params):
+        self.new_conns += 1
+
+    async def __on_conn_reuse(self, session, ctx, params):
+        self.reused_conns += 1
+
+    def conn_stats(self):
+        total = self.new_conns + self.reused_conns
+        return '{} connections opened, {} reused ({:.1f}%), {} retried, {} throttled'.format(
+            self.new_conns,
+            self.reused_conns,
+            self.reused_conns * 100 / total if total else 0,
+            self.retried,
+            self.throttled)
 
     def __del__(self):
-        self.session.connector.close()
+        if not self.session.closed:
+            self.session.connector.close()
 
-    def _save_cookies(self):
+    async def close(self):
+        await self.session.close()
+
+    def save_cookies(self):
         self.session.cookie_jar.save(self.cookie_path)
 
+    def __limiter(self, host):
+        limiter = self.limiters.get(host)
+        if not limiter:
+            limiter = HostLimiter(self.host_rate, self.conn_limit_per_host)
+            self.limiters[host] = limiter
+            metrics.host_concurrency.set_function(
+                lambda: limiter.concurrency, host)
+            metrics.host_rate.set_function(lambda: limiter.rate, host)
+        return limiter
+
+    def __backoff(self, attempt):
+        # exponential backoff with full jitter
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    @staticmethod
+    def __retry_after(resp):
+        value = resp.headers.get('Retry-After')
+        if not value:
+            return None
+        if value.isdigit():
+            return int(value)
+        try:
+            return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    async def __send(self, method, url, headers, data, timeout):
+        host = URL(url).host
+        limiter = self.__limiter(host)
+        attempt = 0
+        while True:
+            await limiter.acquire()
+            st = time.time()
+            try:
+                resp = await self.session.request(
+                    method,
+                    url,
+                    headers=headers,
+                    data=data,
+                    proxy=self.proxy,
+                    timeout=timeout
+                )
+            except self.retry_errors as err:
+                limiter.release()
+                metrics.request_seconds.observe(time.time() - st, host)
+                metrics.requests.inc(host, type(err).__name__)
+                # a reset or timeout is often how a host sheds load
+                if limiter.throttle():
+                    self.throttled += 1
+                    metrics.host_throttles.inc(host)
+                if attempt >= self.retries:
+                    raise
+                delay = self.__backoff(attempt)
+            except BaseException:
+                limiter.release()
+                raise
+            else:
+                metrics.request_seconds.observe(time.time() - st, host)
+                metrics.requests.inc(host, str(resp.status))
+                if resp.status not in self.retry_statuses:
+                    limiter.success()
+                    return resp, limiter
+                retry_after = self.__retry_after(resp)
+                # a longer wait than backoff_max is not sat out
+                if resp.status in self.throttle_statuses and limiter.throttle(
+                        min(retry_after or 0, self.backoff_max)):
+                    self.throttled += 1
+                    metrics.host_throttles.inc(host)
+                if attempt >= self.retries or \
+                        (retry_after or 0) > self.backoff_max:
+                    return resp, limiter
+                resp.release()
+                limiter.release()
+                delay = max(self.__backoff(attempt), retry_after or 0)
+            attempt += 1
+            self.retried += 1
+            metrics.request_retries.inc(host)
+            await asyncio.sleep(delay)
+
     def request(self, url, method='GET', headers={}, data=None, timeout=25):
         _headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; ServiceUI 11) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.36 Edge/16.16299'
         }
         _headers.update(headers)
-        return self.session.request(
-            method,
-            url,
-            headers=_headers,
-            data=data,
-            proxy=self.proxy,
-            timeout=timeout
-        )
+        return _RequestContext(
+            self.__send(method, url, _headers, data, timeout))
+
+
+class HttpClient:
+    # base of the components, which send their requests through the session
+    # of their context
+
+    retry_errors = HttpSession.retry_errors
+
+    def __init__(self, context=None):
+        if context is None:
+            from .context import PixivoContext
+            context = PixivoContext()
+        self.context = context
+        self.path = context.config['path']
+        self.http = context.http
+
+    def conn_stats(self):
+        return self.http.conn_stats()
+
+    def _save_cookies(self):
+        self.http.save_cookies()
+
+    def request(self, url, method='GET', headers={}, data=None, timeout=25):
+        return self.http.request(url, method, headers, data, timeout)
@@ -0,0 +1,251 @@
+import bisect
+import os
+import threading
+import time
+
+from .config import load_config
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _label_str(names, values, extra=''):
+    pairs = ['{}="{}"'.format(name, _escape(value))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in sorted(values):
+            yield self.name, _label_str(self.labels, label_values), value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, labels, _number(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def set_function(self, func, *labels):
+        # read when the metrics are rendered, e.g. a queue size
+        with self.lock:
+            self.values[labels] = func
+
+    def samples(self):
+        for name, labels, value in super().samples():
+            yield name, labels, value() if callable(value) else value
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=default_buckets):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # per bucket counts, then the sum and the count
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        with self.lock:
+            values = [(labels, list(counts))
+                      for labels, counts in self.values.items()]
+        for label_values, counts in sorted(values):
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                yield (self.name + '_bucket',
+                       _label_str(self.labels, label_values,
+                                  'le="{}"'.format(_number(float(bound)))),
+                       total)
+            labels = _label_str(self.labels, label_values)
+            yield self.name + '_sum', labels, counts[-2]
+            yield self.name + '_count', labels, counts[-1]
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+registry = Registry()
+
+start_time = registry.register(Gauge(
+    'pixivo_start_time_seconds', 'Unix time the process started'))
+start_time.set(time.time())
+
+requests = registry.register(Counter(
+    'pixivo_requests_total', 'HTTP requests by host and status or error',
+    ('host', 'status')))
+request_seconds = registry.register(Histogram(
+    'pixivo_request_seconds', 'Time to the response headers of a request',
+    ('host',)))
+request_retries = registry.register(Counter(
+    'pixivo_request_retries_total', 'Requests retried', ('host',)))
+host_throttles = registry.register(Counter(
+    'pixivo_host_throttles_total', 'Times the limits of a host were lowered',
+    ('host',)))
+host_concurrency = registry.register(Gauge(
+    'pixivo_host_concurrency', 'Requests allowed in flight to a host',
+    ('host',)))
+host_rate = registry.register(Gauge(
+    'pixivo_host_rate', 'Requests per second allowed to a host', ('host',)))
+
+rank_pages = registry.register(Counter(
+    'pixivo_rank_pages_total', 'Ranking pages fetched', ('mode',)))
+rank_page_seconds = registry.register(Histogram(
+    'pixivo_rank_page_seconds', 'Time to fetch and store a ranking page'))
+rank_illusts = registry.register(Counter(
+    'pixivo_rank_illusts_total', 'Illusts found in rankings', ('result',)))
+
+downloaded_bytes = registry.register(Counter(
+    'pixivo_downloaded_bytes_total', 'Bytes received for files'))
+files = registry.register(Counter(
+    'pixivo_files_total', 'Files handled by type and result',
+    ('type', 'result')))
+stage_seconds = registry.register(Histogram(
+    'pixivo_stage_seconds', 'Time a file spends in a download stage',
+    ('stage',)))
+queue_depth = registry.register(Gauge(
+    'pixivo_queue_depth', 'Items waiting in a downloader queue', ('queue',)))
+
+db_writes = registry.register(Counter(
+    'pixivo_db_writes_total', 'Database write statements'))
+db_commit_seconds = registry.register(Histogram(
+    'pixivo_db_commit_seconds', 'Time of a database commit'))
+db_pending = registry.register(Gauge(
+    'pixivo_db_pending_writes', 'Writes waiting for the next batch commit'))
+
+
+class MetricsExporter:
+    # serves the registry on a local port and/or writes it to a file
+
+    def __init__(self, config=None):
+        if config is None:
+            config = load_config()
+        self.port = config.get('metrics_port')
+        self.file = config.get('metrics_file')
+        self.interval = config.get('metrics_interval') or 10
+        self.users = 0
+        self.runner = None
+        self.writer = None
+
+    async def __handle(self, request):
+        from aiohttp import web
+        return web.Response(
+            text=registry.render(),
+            headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+    def write(self):
+        tmp_path = self.file + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as fp:
+            fp.write(registry.render())
+        os.replace(tmp_path, self.file)
+
+    async def __write_loop(self):
+        import asyncio
+
+        while True:
+            await asyncio.sleep(self.interval)
+            self.write()
+
+    async def start(self):
+        self.users += 1
+        if self.users > 1:
+            return
+        if self.port:
+            from aiohttp import web
+            app = web.Application()
+            app.router.add_get('/metrics', self.__handle)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, '127.0.0.1', self.port).start()
+            print('Metrics on http://127.0.0.1:{}/metrics'.format(self.port))
+        if self.file:
+            import asyncio
+
+            self.writer = asyncio.ensure_future(self.__write_loop())
+
+    async def stop(self):
+        self.users -= 1
+        if self.users:
+            return
+        if self.writer:
+            self.writer.cancel()
+            self.writer = None
+            self.write()
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+_exporter = None
+
+
+def exporter(config=None):
+    global _exporter
+    if _exporter is None:
+        _exporter = MetricsExporter(config)
+    return _exporter
@@ -9,8 +9,8 @@ from .httpclient import HttpClient
 
 class PixivoLogin(HttpClient):
 
-    def __init__(self, pixiv_id, password):
-        super().__init__()
+    def __init__(self, pixiv_id, password, context=None):
+        super().__init__(context)
 
         self.pixiv_id = pixiv_id
         self.password = password
@@ -69,8 +69,8 @@ class PixivoLogin(HttpClient):
 
 class PixivoAuth(HttpClient):
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, context=None):
+        super().__init__(context)
 
     async def checkLogin(self):
         async with self.request('https://www.pixiv.net') as resp:
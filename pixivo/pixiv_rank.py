@@ -1,98 +1,176 @@
+import asyncio
 import datetime
 import json
 import re
 import time
 
-import yaml
-from pytz import timezone
+import aiohttp
 
-from .database import PixivoDatabase
+from . import metrics
 from .exceptions import PixivoSpiderException
 from .httpclient import HttpClient
 from .pixiv_auth import PixivoAuth
 
 
 class PixivoRankSpider(HttpClient):
+    rank_page_size = 50
+    crawl_errors = (PixivoSpiderException, aiohttp.ClientError,
+                    asyncio.TimeoutError)
 
-    def __init__(self):
-        super().__init__()
-        self.auth = PixivoAuth()
+    def __init__(self, context=None):
+        super().__init__(context)
+        self.auth = PixivoAuth(self.context)
 
         self.context_token = None
 
-        self.data_base = PixivoDatabase()
+        self.data_base = self.context.async_data_base
 
-        with open('_config.yml') as fp:
-            config = yaml.load(fp)
-            r18 = config['r18'] if config['r18'] == True else False
-            self.content_type = config['type'] or 'all'
-            if self.content_type not in ['all', 'illust', 'manga', 'ugoira']:
+        config = self.context.config
+        r18 = config['r18'] if config['r18'] == True else False
+        self.content_types = self.__as_list(config['type']) or ['all']
+        for content_type in self.content_types:
+            if content_type not in ['all', 'illust', 'manga', 'ugoira']:
                 raise PixivoSpiderException(
-                    'Can\'t got the "%s" ranking from pixiv!' % self.content_type
+                    'Can\'t got the "%s" ranking from pixiv!' % content_type
                 )
-            self.date_str = config['date']
-            if not self.date_str:
-                today = datetime.datetime.now()
-                today = today.astimezone(timezone('Japan'))
-                yesterday = today - datetime.timedelta(days=1)
-                self.date_str = yesterday.strftime('%Y%m%d')
-            self.mode = 'daily'
-            if r18:
-                self.mode = 'daily_r18'
+        date_str = config['date']
+        if not date_str:
+            from pytz import timezone
 
-    async def __getRanking(self, page):
+            today = datetime.datetime.now()
+            today = today.astimezone(timezone('Japan'))
+            yesterday = today - datetime.timedelta(days=1)
+            date_str = yesterday.strftime('%Y%m%d')
+        self.dates = self.__date_range(
+            str(date_str), str(config.get('date_end') or date_str))
+        if not self.dates:
+            raise PixivoSpiderException(
+                'The date_end {} is before the date {}!'.format(
+                    config.get('date_end'), date_str))
+        self.modes = self.__as_list(config.get('mode'))
+        if not self.modes:
+            self.modes = ['daily_r18'] if r18 else ['daily']
+        self.semaphore = asyncio.Semaphore(
+            config.get('rank_concurrency') or 4)
+
+    @staticmethod
+    def __as_list(value):
+        if not value:
+            return []
+        if isinstance(value, (list, tuple)):
+            return list(value)
+        return [value]
+
+    @staticmethod
+    def __date_range(date_begin, date_end):
+        try:
+            day = datetime.datetime.strptime(date_begin, '%Y%m%d')
+            last_day = datetime.datetime.strptime(date_end, '%Y%m%d')
+        except ValueError:
+            raise PixivoSpiderException(
+                'Date must be in the format like 20180214!')
+        dates = []
+        while day <= last_day:
+            dates.append(day.strftime('%Y%m%d'))
+            day += datetime.timedelta(days=1)
+        return dates
+
+    async def __getRanking(self, mode, content_type, date_str, page):
         rank_url = 'https://www.pixiv.net/ranking.php?mode={}{}&p={}&date={}&format=json&tt={}'\
             .format(
-                self.mode,
-                '&content={}'.format(self.content_type)
-                if self.content_type != 'all' else '',
+                mode,
+                '&content={}'.format(content_type)
+                if content_type != 'all' else '',
                 page,
-                self.date_str,
+                date_str,
                 self.context_token
             )
-        async with self.request(rank_url, timeout=None) as resp:
-            text = await resp.text()
-            try:
-                res_json = json.loads(text)
-                if 'error' in res_json:
-                    raise PixivoSpiderException(res_json['error'])
-                ranks = res_json['contents']
-                for illust in ranks:
-                    illust_id = illust['illust_id']
-                    user_id = illust['user_id']
-                    user_name = illust['user_name']
-                    tags = illust['tags']
-                    print('''
+        st = time.time()
+        async with self.semaphore:
+            async with self.request(rank_url, timeout=None) as resp:
+                text = await resp.text()
+        try:
+            res_json = json.loads(text)
+        except json.decoder.JSONDecodeError:
+            raise PixivoSpiderException(
+                'Please confirm your configs in _config.yml.')
+        if 'error' in res_json:
+            raise PixivoSpiderException(res_json['error'])
+        ranks = res_json['contents']
+        for illust in ranks:
+            print('''
 rank: {}
 illust_id: {}
 title: {}
 user_name: {}
-tags: {}'''.format(illust['rank'], illust_id, illust['title'], user_name, tags))
-                    if not self.data_base.exist_illust(illust_id):
-                        self.data_base.insert_illust(illust)
-                    else:
-                        self.data_base.update_illust(illust_id, illust)
-                    if not self.data_base.exist_user(user_id):
-                        self.data_base.insert_user(user_id, user_name)
-                    else:
-                        self.data_base.update_user(user_id, user_name)
-                return res_json['next']
-            except json.decoder.JSONDecodeError:
-                raise PixivoSpiderException(
-                    'Please confirm your configs in _config.yml.')
+tags: {}'''.format(illust['rank'], illust['illust_id'], illust['title'],
+                   illust['user_name'], illust['tags']))
+        new_ids, updated_ids = await self.data_base.upsert_ranking(ranks)
+        self.data_base.post('set_rank_page', mode, content_type, date_str,
+                            page, res_json.get('rank_total'))
+        metrics.rank_pages.inc(mode)
+        metrics.rank_illusts.inc('new', amount=len(new_ids))
+        metrics.rank_illusts.inc('updated', amount=len(updated_ids))
+        metrics.rank_page_seconds.observe(time.time() - st)
+        print('\n{} {} {} page {}: {} new, {} updated'.format(
+            date_str, mode, content_type, page,
+            len(new_ids), len(updated_ids)))
+        return res_json
+
+    def __report_error(self, mode, content_type, date_str, err):
+        print('\n{} {} {} -x> {}'.format(date_str, mode, content_type, err))
 
-        return False
+    async def __crawlRanking(self, mode, content_type, date_str):
+        done_pages, rank_total = await self.data_base.get_rank_pages(
+            mode, content_type, date_str)
+        if not rank_total:
+            try:
+                res_json = await self.__getRanking(
+                    mode, content_type, date_str, 1)
+                rank_total = res_json.get('rank_total')
+                done_pages = set([1])
+                if not rank_total:
+                    # the page count is unknown, follow the links one by one
+                    page = res_json['next']
+                    while page:
+                        res_json = await self.__getRanking(
+                            mode, content_type, date_str, page)
+                        page = res_json['next']
+                    return
+            except self.crawl_errors as err:
+                self.__report_error(mode, content_type, date_str, err)
+                return
+        page_count = -(-int(rank_total) // self.rank_page_size)
+        results = await asyncio.gather(*[
+            self.__getRanking(mode, content_type, date_str, page)
+            for page in range(1, page_count + 1)
+            if page not in done_pages
+        ], return_exceptions=True)
+        for result in results:
+            if isinstance(result, self.crawl_errors):
+                self.__report_error(mode, content_type, date_str, result)
+            elif isinstance(result, BaseException):
+                raise result
 
     async def getRankingList(self):
         self.context_token = await self.auth.getContextToken()
         print('Spider config:')
-        print('- Mode: {}'.format(self.mode))
-        print('- Date: {}'.format(self.date_str))
-        print('- Type: {}'.format(self.content_type))
-        page = 1
-        page = await self.__getRanking(page)
+        print('- Mode: {}'.format(', '.join(self.modes)))
+        print('- Date: {}'.format(
+            self.dates[0] if len(self.dates) == 1
+            else '{} - {}'.format(self.dates[0], self.dates[-1])))
+        print('- Type: {}'.format(', '.join(self.content_types)))
         start = time.time()
-        while page:
-            page = await self.__getRanking(page)
+        await metrics.exporter(self.context.config).start()
+        try:
+            await asyncio.gather(*[
+                self.__crawlRanking(mode, content_type, date_str)
+                for date_str in self.dates
+                for mode in self.modes
+                for content_type in self.content_types
+            ])
+        finally:
+            await metrics.exporter(self.context.config).stop()
         print()
+        print('-- {}'.format(self.conn_stats()))
         print('Finished in {} s!'.format(time.time() - start))
@@ -2,18 +2,21 @@ import os
 import json
 import time
 import sys
-import shutil
-import yaml
 
-from .database import PixivoDatabase
+from .context import PixivoContext
+from .export import ResultExporter, clear_path
 
 
 class PixivoSearcher:
 
-    def __init__(self):
-        with open('_config.yml') as fp:
-            config = yaml.load(fp)
-            self.result_path = config['r_path']
+    def __init__(self, context=None):
+        self.context = context or PixivoContext()
+        config = self.context.config
+        self.result_path = config['r_path']
+        self.page_size = config.get('page_size') or 10
+        self.export_mode = config.get('export_mode') or 'auto'
+        self.export_workers = config.get('export_workers') or 8
+        self.export_archive = config.get('export_archive')
 
         if os.path.isdir(self.result_path):
             old_results = os.listdir(self.result_path)
@@ -23,15 +26,35 @@ class PixivoSearcher:
                     .format(len(old_results)))
                 sel = sel.lower()
                 if sel == 'y':
-                    for old_result in old_results:
-                        os.remove(os.path.join(self.result_path, old_result))
+                    clear_path(self.result_path, self.export_workers)
                     print('Result path cleared.')
         else:
             os.mkdir(self.result_path)
             print('Result path created.')
         print('The result path is {}/. Where all output files will be placed.'
               .format(self.result_path))
-        self.data_base = PixivoDatabase()
+        self.data_base = self.context.data_base
+
+    def __exporter(self, sel):
+        if sel != 'y':
+            return None
+        return ResultExporter(self.result_path, self.export_mode,
+                              self.export_workers, self.export_archive)
+
+    def __export_files(self, exporter, illust_id, prefix):
+        if exporter is None:
+            return
+        for file in self.data_base.get_files_for_illust(illust_id):
+            exporter.add(
+                file[0], prefix + os.path.basename(file[0]))
+
+    @staticmethod
+    def __finish_export(exporter):
+        if exporter is None:
+            return
+        exporter.close()
+        print('All results are exported to the result path: {}.'.format(
+            exporter.summary()))
 
     def searchIllustId(self, illust_id):
         illust_status = self.data_base.get_illust_status(illust_id)
@@ -43,7 +66,7 @@ class PixivoSearcher:
             sys.exit(0)
         sel = input(
             '> Do you want to copy the results to the result path?[y/n]')
-        sel = sel.lower()
+        exporter = self.__exporter(sel.lower())
         illust_info = self.data_base.get_illust_info(illust_id)
         print('=' * 3 + 'Result' + '=' * 3)
         print('ID: \t{}'.format(illust_id))
@@ -56,16 +79,8 @@ class PixivoSearcher:
         print('Rate: \t{}'.format(illust_info[6]))
         print('View: \t{}'.format(illust_info[7]))
         print('=' * 12)
-        if sel == 'y':
-            files = self.data_base.get_files_for_illust(illust_id)
-            for file in files:
-                base_name = os.path.basename(file[0])
-                shutil.copy(
-                    file[0],
-                    os.path.join(self.result_path,
-                                 '{}_{}'.format(illust_id, base_name))
-                )
-            print('All results are copied to the result path.')
+        self.__export_files(exporter, illust_id, '{}_'.format(illust_id))
+        self.__finish_export(exporter)
 
     def searchUserId(self, user_id):
         if not self.data_base.exist_user(user_id):
@@ -73,50 +88,46 @@ class PixivoSearcher:
             sys.exit(0)
         sel = input(
             '> Do you want to copy the results to the result path?[y/n]')
-        sel = sel.lower()
+        exporter = self.__exporter(sel.lower())
         user_name = self.data_base.get_user_name(user_id)
         print('*' * 3 + 'Result' + '*' * 3)
         print('ID: \t{}'.format(user_id))
         print('NAME: \t' + user_name)
         print('*' * 12)
-        page = 1
-        works = self.data_base.get_illust_info_by_user_id(user_id, page)
+        works, cursor = self.data_base.get_illust_info_by_user_id(
+            user_id, limit=self.page_size)
         num = 0
-        while works:
-            for work in works:
-                num += 1
-                print('=' * 12)
-                print('ID: \t{}'.format(work[0]))
-                print('Title: \t' + work[1])
-                st = time.localtime(work[2])
-                print('Time: \t' + time.strftime('%Y-%m-%d %H:%M:%S', st))
-                print('User: \t{}(id={})'.format(
-                    user_name, user_id))
-                print('Pages: \t{}'.format(work[3]))
-                print('Tags: \t{}'.format(
-                    '、'.join(json.loads(work[4]))))
-                print('Rate: \t{}'.format(work[5]))
-                print('View: \t{}'.format(work[6]))
-                print('=' * 12)
-                if sel == 'y':
-                    files = self.data_base.get_files_for_illust(work[0])
-                    for file in files:
-                        base_name = os.path.basename(file[0])
-                        shutil.copy(
-                            file[0],
-                            os.path.join(self.result_path,
-                                         '{}_{}_{}'.format(num, work[0], base_name))
-                        )
-            page += 1
-            works = self.data_base.get_illust_info_by_user_id(user_id, page)
-            input('Press Enter to continue.')
-        print('All results is presented!')
-        if sel == 'y':
-            print('All results are copied to the result path.')
+        try:
+            while works:
+                for work in works:
+                    num += 1
+                    print('=' * 12)
+                    print('ID: \t{}'.format(work[0]))
+                    print('Title: \t' + work[1])
+                    st = time.localtime(work[2])
+                    print('Time: \t' + time.strftime('%Y-%m-%d %H:%M:%S', st))
+                    print('User: \t{}(id={})'.format(
+                        user_name, user_id))
+                    print('Pages: \t{}'.format(work[3]))
+                    print('Tags: \t{}'.format(
+                        '、'.join(json.loads(work[4]))))
+                    print('Rate: \t{}'.format(work[5]))
+                    print('View: \t{}'.format(work[6]))
+                    print('=' * 12)
+                    self.__export_files(
+                        exporter, work[0], '{}_{}_'.format(num, work[0]))
+                if not cursor:
+                    break
+                input('Press Enter to continue.')
+                works, cursor = self.data_base.get_illust_info_by_user_id(
+                    user_id, cursor, self.page_size)
+            print('All results is presented!')
+        finally:
+            self.__finish_export(exporter)
 
     def searchUsername(self, u_name):
-        page = 1
-        users = self.data_base.get_user_by_name(u_name, page)
+        users, cursor = self.data_base.get_user_by_name(
+            u_name, limit=self.page_size)
         if not users:
             print('No results from the database.')
             sys.exit(0)
@@ -128,47 +139,45 @@ class PixivoSearcher:
                 print('No.{}'.format(num))
                 print('ID: \t{}'.format(user[0]))
                 print('NAME: \t' + user[1])
-            page += 1
-            users = self.data_base.get_user_by_name(u_name, page)
+            if not cursor:
+                break
             input('Press Enter to continue.')
+            users, cursor = self.data_base.get_user_by_name(
+                u_name, cursor, self.page_size)
 
-    def searchTitleAndTags(self, keyword):
-        page = 1
-        works = self.data_base.get_illust_info_by_keyword(keyword, page)
+    def searchTitleAndTags(self, keyword, exact=False):
+        works, cursor = self.data_base.get_illust_info_by_keyword(
+            keyword, limit=self.page_size, exact=exact)
         if not works:
             print('No results from the database.')
             sys.exit(0)
         sel = input(
             '> Do you want to copy the results to the result path?[y/n]')
-        sel = sel.lower()
+        exporter = self.__exporter(sel.lower())
         num = 0
-        while works:
-            for work in works:
-                num += 1
-                print()
-                print('ID: \t{}'.format(work[0]))
-                print('Title: \t' + work[1])
-                st = time.localtime(work[2])
-                print('Time: \t' + time.strftime('%Y-%m-%d %H:%M:%S', st))
-                print('User: \t{}(id={})'.format(
-                    work[3], work[4]))
-                print('Pages: \t{}'.format(work[5]))
-                print('Tags: \t{}'.format(
-                    '、'.join(json.loads(work[6]))))
-                print('Rate: \t{}'.format(work[7]))
-                print('View: \t{}'.format(work[8]))
-                if sel == 'y':
-                    files = self.data_base.get_files_for_illust(work[0])
-                    for file in files:
-                        base_name = os.path.basename(file[0])
-                        shutil.copy(
-                            file[0],
-                            os.path.join(self.result_path,
-                                         '{}_{}_{}'.format(num, work[0], base_name))
-                        )
-            page += 1
-            works = self.data_base.get_illust_info_by_keyword(keyword, page)
-            input('Press Enter to continue.')
-        print('All results is presented!')
-        if sel == 'y':
-            print('All results are copied to the result path.')
+        try:
+            while works:
+                for work in works:
+                    num += 1
+                    print()
+                    print('ID: \t{}'.format(work[0]))
+                    print('Title: \t' + work[1])
+                    st = time.localtime(work[2])
+                    print('Time: \t' + time.strftime('%Y-%m-%d %H:%M:%S', st))
+                    print('User: \t{}(id={})'.format(
+                        work[3], work[4]))
+                    print('Pages: \t{}'.format(work[5]))
+                    print('Tags: \t{}'.format(
+                        '、'.join(json.loads(work[6]))))
+                    print('Rate: \t{}'.format(work[7]))
+                    print('View: \t{}'.format(work[8]))
+                    self.__export_files(
+                        exporter, work[0], '{}_{}_'.format(num, work[0]))
+                if not cursor:
+                    break
+                input('Press Enter to continue.')
+                works, cursor = self.data_base.get_illust_info_by_keyword(
+                    keyword, cursor, self.page_size, exact)
+            print('All results is presented!')
+        finally:
+            self.__finish_export(exporter)
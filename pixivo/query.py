@@ -0,0 +1,104 @@
+import json
+from collections import OrderedDict, namedtuple
+
+from .context import PixivoContext
+
+Illust = namedtuple('Illust', [
+    'id', 'title', 'date', 'user_id', 'user_name', 'pages', 'tags',
+    'rating', 'view'])
+User = namedtuple('User', ['id', 'name'])
+
+
+class PixivoQuery:
+    # the searches of PixivoSearcher without prompts or prints: results are
+    # namedtuples yielded lazily page by page, recent pages are kept in an
+    # LRU cache until the database changes
+
+    def __init__(self, context=None, cache_size=None):
+        self.context = context or PixivoContext()
+        config = self.context.config
+        self.page_size = config.get('page_size') or 10
+        if cache_size is None:
+            cache_size = config.get('query_cache') or 128
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self.data_base = self.context.data_base
+
+    def __cached(self, name, *args):
+        generation = self.data_base.generation()
+        if generation != self.generation:
+            self.cache.clear()
+            self.generation = generation
+        key = (name,) + args
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return self.cache[key]
+        self.misses += 1
+        result = getattr(self.data_base, name)(*args)
+        if self.cache_size:
+            self.cache[key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return result
+
+    def __paged(self, fetch, limit):
+        # fetch(cursor) gives a page of rows and the cursor of the next one
+        count = 0
+        cursor = None
+        while True:
+            rows, cursor = fetch(cursor)
+            for row in rows:
+                if limit is not None and count >= limit:
+                    return
+                count += 1
+                yield row
+            if not cursor:
+                return
+
+    def illust(self, illust_id):
+        info = self.__cached('get_illust_info', illust_id)
+        if not info:
+            return None
+        title, date, user_name, user_id, pages, tags, rating, view = info
+        return Illust(illust_id, title, date, user_id, user_name, pages,
+                      json.loads(tags), rating, view)
+
+    def files(self, illust_id):
+        # the paths of the downloaded files of an illust
+        return [row[0] for row in
+                self.__cached('get_files_for_illust', illust_id)]
+
+    def user(self, user_id):
+        if not self.__cached('exist_user', user_id):
+            return None
+        return User(user_id, self.__cached('get_user_name', user_id))
+
+    def illusts_by_user(self, user_id, limit=None):
+        user = self.user(user_id)
+        if user is None:
+            return
+        rows = self.__paged(lambda cursor: self.__cached(
+            'get_illust_info_by_user_id', user_id, cursor, self.page_size),
+            limit)
+        for illust_id, title, date, pages, tags, rating, view in rows:
+            yield Illust(illust_id, title, date, user.id, user.name, pages,
+                         json.loads(tags), rating, view)
+
+    def users_by_name(self, user_name, limit=None):
+        rows = self.__paged(lambda cursor: self.__cached(
+            'get_user_by_name', user_name, cursor, self.page_size), limit)
+        for user_id, name in rows:
+            yield User(user_id, name)
+
+    def illusts_by_keyword(self, keyword, exact=False, limit=None):
+        rows = self.__paged(lambda cursor: self.__cached(
+            'get_illust_info_by_keyword', keyword, cursor, self.page_size,
+            exact), limit)
+        for (illust_id, title, date, user_name, user_id, pages, tags,
+             rating, view) in rows:
+            yield Illust(illust_id, title, date, user_id, user_name, pages,
+                         json.loads(tags), rating, view)
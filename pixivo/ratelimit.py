@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+
+class HostLimiter:
+    # a token bucket and a concurrency limit for one host, both halved when
+    # the host throttles and grown back slowly while requests succeed
+
+    cooldown = 1
+
+    def __init__(self, rate, concurrency):
+        self.max_rate = self.rate = rate
+        self.max_concurrency = self.concurrency = concurrency
+        self.tokens = rate
+        self.stamp = time.monotonic()
+        self.active = 0
+        self.succeeded = 0
+        self.paused_until = 0
+        self.throttled_at = 0
+        self.waiters = []
+
+    def __refill(self, now):
+        self.tokens = min(
+            self.max_rate, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.__refill(now)
+            wait = self.paused_until - now
+            if wait <= 0 and self.tokens < 1:
+                wait = (1 - self.tokens) / self.rate
+            if wait > 0:
+                await asyncio.sleep(wait)
+            elif self.active >= self.concurrency:
+                waiter = asyncio.get_event_loop().create_future()
+                self.waiters.append(waiter)
+                try:
+                    await waiter
+                finally:
+                    if waiter in self.waiters:
+                        self.waiters.remove(waiter)
+            else:
+                self.tokens -= 1
+                self.active += 1
+                return
+
+    def release(self):
+        self.active -= 1
+        self.__wake()
+
+    def __wake(self):
+        free = self.concurrency - self.active
+        while free > 0 and self.waiters:
+            waiter = self.waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def success(self):
+        # one more slot after a full round of successes
+        self.succeeded += 1
+        if self.succeeded < self.concurrency:
+            return
+        self.succeeded = 0
+        if self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+            self.__wake()
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def throttle(self, delay=None):
+        now = time.monotonic()
+        if delay:
+            self.paused_until = max(self.paused_until, now + delay)
+        # the requests in flight fail together, count them as one signal
+        if now - self.throttled_at < self.cooldown:
+            return False
+        self.throttled_at = now
+        self.succeeded = 0
+        self.concurrency = max(1, self.concurrency // 2)
+        self.rate = max(self.max_rate / 100, self.rate / 2)
+        return True
@@ -0,0 +1,52 @@
+import io
+import os
+import time
+from zipfile import ZipFile
+
+ugoira_names = {
+    'gif': 'p0.gif',
+    'webp': 'p0.webp',
+    'apng': 'p0.png'
+}
+
+
+def _save_gif(zf, frames_info, out_name):
+    # frames are decoded and handed to the encoder one at a time
+    import imageio
+
+    delays = [frame['delay'] / 1000 for frame in frames_info]
+    with imageio.get_writer(out_name, 'GIF', mode='I', duration=delays) as writer:
+        for frame in frames_info:
+            writer.append_data(imageio.imread(zf.read(frame['file'])))
+
+
+def _save_pillow(zf, frames_info, out_name, pil_format):
+    from PIL import Image
+
+    images = [Image.open(io.BytesIO(zf.read(frame['file'])))
+              for frame in frames_info]
+    images[0].save(
+        out_name, pil_format,
+        save_all=True,
+        append_images=images[1:],
+        duration=[frame['delay'] for frame in frames_info],
+        loop=0
+    )
+
+
+def convert_ugoira(zip_path, frames_info, out_name, ugoira_format='gif'):
+    # runs in a worker process, returns the seconds spent on converting
+    st = time.time()
+    with open(zip_path, 'rb') as fp:
+        zip_data = io.BytesIO(fp.read())
+    with ZipFile(zip_data) as zf:
+        if ugoira_format == 'gif':
+            _save_gif(zf, frames_info, out_name)
+        elif ugoira_format == 'webp':
+            _save_pillow(zf, frames_info, out_name, 'WEBP')
+        elif ugoira_format == 'apng':
+            _save_pillow(zf, frames_info, out_name, 'PNG')
+        else:
+            raise ValueError('Unknown ugoira format "%s"!' % ugoira_format)
+    os.remove(zip_path)
+    return time.time() - st